@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+###########################################################################
+# Copyright (C) 2013-2022 by Caspar. All rights reserved.
+# File Name: bench.py
+# Author: Shankai Yan
+# E-mail: dr.skyan@gmail.com
+# Created Time: 2022-02-14 10:21:37
+###########################################################################
+#
+
+import os, sys, json, time, shutil, platform, tempfile, threading, subprocess, argparse, tracemalloc
+
+from .shell import CloudShell
+from .ratelimit import TokenBucket
+from .rclone import RcloneTransfer
+
+
+LIBS_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CLOUD_MODULES = ['dslib.cloud.onedrive', 'dslib.cloud.aliyundrive', 'dslib.cloud.gdrive']
+IMPORT_BUDGET_MS = 50
+GSHEET_SHAPES = [(10, 5), (1000, 20), (20000, 30)]
+# (number of files, bytes per file) from many small files to a few large ones
+SHELL_SCENARIOS = [(200, 4 << 10), (50, 256 << 10), (4, 16 << 20)]
+REMOTE_LATENCY = 0.005
+REMOTE_BANDWIDTH = 50 << 20
+SHIM_CHUNK = 1 << 20
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values: return 0.0
+    k = (len(values) - 1) * q / 100.0
+    f, c = int(k), min(int(k) + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def bench_import(modules=CLOUD_MODULES, repeat=5, budget_ms=IMPORT_BUDGET_MS, verbose=False):
+    # Import each module in a fresh interpreter so that nothing is served from `sys.modules`
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([LIBS_PATH] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    results = {}
+    for mdl in modules:
+        code = 'import time; t = time.perf_counter(); import %s; print((time.perf_counter() - t) * 1000)' % mdl
+        timings = []
+        for i in range(repeat):
+            try:
+                timings.append(float(subprocess.check_output([sys.executable, '-c', code], env=env, stderr=subprocess.PIPE).decode('utf-8').strip()))
+            except subprocess.CalledProcessError as e:
+                print('Failed to import %s: %s' % (mdl, e.stderr.decode('utf-8').strip().splitlines()[-1]))
+                break
+        if not timings: continue
+        results[mdl] = dict(repeat=len(timings), min_ms=min(timings), p50_ms=_percentile(timings, 50), max_ms=max(timings), ok=_percentile(timings, 50) <= budget_ms)
+        if verbose: print('%s: %.2f ms (p50 of %i runs)%s' % (mdl, results[mdl]['p50_ms'], len(timings), '' if results[mdl]['ok'] else ' [over budget %i ms]' % budget_ms))
+    return results
+
+
+def _legacy_write(worksheet, dataframe, rect2range):
+    # The four separate updates that `to_gsheet` used to send (corner, header, index, body)
+    worksheet.update('A1', dataframe.index.name)
+    worksheet.update(rect2range((0, 1, 1, len(dataframe.columns))), [dataframe.columns.tolist()])
+    worksheet.update(rect2range((1, 0, len(dataframe.index), 1)), [[idx] for idx in dataframe.index])
+    worksheet.update(rect2range((1, 1) + dataframe.shape), dataframe.values.tolist())
+
+
+def bench_gsheet_write(shapes=GSHEET_SHAPES, chunk_cells=None, workers=1, verbose=False):
+    # Count the requests and time of `to_gsheet` against the in-memory gspread fake, next to the legacy sequence of updates
+    import numpy as np
+    import pandas as pd
+    from . import gdrive, fakes
+    results = {}
+    with tempfile.TemporaryDirectory() as root_path:
+        service = fakes.install(gdrive, root_path)
+        for nrows, ncols in shapes:
+            dataframe = pd.DataFrame(np.random.rand(nrows, ncols), columns=['c%i' % i for i in range(ncols)])
+            service.reset()
+            start_time = time.time()
+            worksheet = gdrive.get_gsheet(gdrive.GSC.create('legacy_%ix%i' % (nrows, ncols), folder_id=''))
+            # The legacy code never resized, give it a grid that fits without counting a request
+            worksheet._row_count, worksheet._col_count = nrows + 1, ncols + 1
+            _legacy_write(worksheet, dataframe, gdrive.rect2range)
+            legacy = dict(requests=service.requests['total'], writes=service.requests['values.update'], seconds=time.time() - start_time)
+            service.reset()
+            start_time = time.time()
+            gdrive.to_gsheet(dataframe, os.path.join(gdrive.DATA_ROOT_PATH, 'bench_%ix%i' % (nrows, ncols)), folder_id='', chunk_cells=chunk_cells or gdrive.GSHEET_CHUNK_CELLS, workers=workers)
+            batched = dict(requests=service.requests['total'], writes=service.requests['values.update'], seconds=time.time() - start_time)
+            results['%ix%i' % (nrows, ncols)] = dict(legacy=legacy, batched=batched)
+            if verbose: print('%ix%i: %i requests (legacy %i), %i value writes (legacy %i), %.3fs' % (nrows, ncols, batched['requests'], legacy['requests'], batched['writes'], legacy['writes'], batched['seconds']))
+    return results
+
+
+def _environment():
+    return dict(timestamp=time.time(), python=platform.python_version(), platform=platform.platform(), cpus=os.cpu_count())
+
+
+def _measure(func, items):
+    # Call `func` on every item under tracemalloc, return the timings and the peak of traced memory
+    timings = []
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        for item in items:
+            t = time.perf_counter()
+            func(item)
+            timings.append(time.perf_counter() - t)
+        seconds = time.perf_counter() - start_time
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dict(ops=len(timings), seconds=seconds, p50_ms=_percentile(timings, 50) * 1000, p95_ms=_percentile(timings, 95) * 1000, p99_ms=_percentile(timings, 99) * 1000,
+        max_ms=max(timings or [0]) * 1000, peak_mb=peak / float(1 << 20))
+
+
+class ThrottledShell(CloudShell):
+    # `CloudShell` over a local "cloud" directory where every copy from or to the cloud side waits `latency` seconds and
+    # streams through a token bucket of `bandwidth` bytes per second shared by all threads. Stats and directory listings
+    # of the cloud side wait `latency` seconds too, every one of these counts in `remote_ops`.
+    def __init__(self, cloud_path_root, local_path_root, latency=REMOTE_LATENCY, bandwidth=REMOTE_BANDWIDTH, **kwargs):
+        super(ThrottledShell, self).__init__(cloud_path_root, local_path_root, **kwargs)
+        self.latency = latency
+        self.bucket = TokenBucket(bandwidth, capacity=SHIM_CHUNK) if bandwidth else None
+        self.remote_ops = 0
+        self._ops_lock = threading.Lock()
+
+    def _remote_op(self):
+        with self._ops_lock:
+            self.remote_ops += 1
+        if self.latency: time.sleep(self.latency)
+
+    def _cloud_stat(self, cloud_fpath):
+        self._remote_op()
+        return super(ThrottledShell, self)._cloud_stat(cloud_fpath)
+
+    def _cloud_scandir(self, path):
+        self._remote_op()
+        return super(ThrottledShell, self)._cloud_scandir(path)
+
+    def _copy(self, src_fpath, tgt_fpath):
+        if not any(p.startswith(self.cloud_path_root + os.sep) for p in (src_fpath, tgt_fpath)):
+            return super(ThrottledShell, self)._copy(src_fpath, tgt_fpath)
+        self._remote_op()
+        self._makedirs(os.path.dirname(tgt_fpath))
+        with open(src_fpath, 'rb') as src_fd, open(tgt_fpath, 'wb') as tgt_fd:
+            while True:
+                data = src_fd.read(SHIM_CHUNK)
+                if not data: break
+                if self.bucket is not None: self.bucket.acquire(len(data))
+                tgt_fd.write(data)
+        shutil.copystat(src_fpath, tgt_fpath)
+
+
+def _write_csv_files(dir_path, nfiles, size):
+    # CSV files of about `size` bytes with a header and numeric rows
+    row = ','.join('%.6f' % (i / 7.0) for i in range(8)) + '\n'
+    content = 'c0,c1,c2,c3,c4,c5,c6,c7\n' + row * max(1, size // len(row))
+    os.makedirs(dir_path, exist_ok=True)
+    for i in range(nfiles):
+        with open(os.path.join(dir_path, 'f%05i.csv' % i), 'w') as fd:
+            fd.write(content)
+    return len(content.encode('utf-8'))
+
+
+def bench_shell(scenarios=SHELL_SCENARIOS, latency=REMOTE_LATENCY, bandwidth=REMOTE_BANDWIDTH, workers=4, verbose=False):
+    # Time `CloudShell.sync` (cold and warm), `batch_sync` and `read_csv` (plain, then with the frame cache) against the throttled shim
+    # Import pandas up front so that it is not counted in the first measurement
+    import pandas
+    results = {}
+    for nfiles, size in scenarios:
+        with tempfile.TemporaryDirectory() as root_path:
+            cloud_path = os.path.join(root_path, 'cloud')
+            file_size = _write_csv_files(cloud_path, nfiles, size)
+            fnames = sorted(os.listdir(cloud_path))
+            total_bytes = file_size * nfiles
+            scenario = results['%ix%s' % (nfiles, _size_str(size))] = dict(files=nfiles, file_bytes=file_size)
+            def throughput(r, nbytes=total_bytes):
+                r.update(bytes=nbytes, throughput_mb_s=nbytes / float(1 << 20) / max(r['seconds'], 1e-9))
+                return r
+            local_path = os.path.join(root_path, 'sync')
+            shell = ThrottledShell(cloud_path, local_path, latency=latency, bandwidth=bandwidth, workers=workers)
+            fpaths = [os.path.join(local_path, f) for f in fnames]
+            scenario['sync_cold'] = throughput(_measure(shell.sync, fpaths))
+            scenario['sync_warm'] = throughput(_measure(shell.sync, fpaths), 0)
+            scenario['sync_cold']['remote_ops'] = shell.remote_ops
+            shell.close()
+            local_path = os.path.join(root_path, 'batch')
+            shell = ThrottledShell(cloud_path, local_path, latency=latency, bandwidth=bandwidth, workers=workers)
+            batch = _measure(lambda fpaths: shell.batch_sync(fpaths, workers=workers), [[os.path.join(local_path, f) for f in fnames]])
+            scenario['batch_sync'] = throughput(dict((k, batch[k]) for k in ['seconds', 'peak_mb']), total_bytes)
+            scenario['batch_sync'].update(workers=workers, remote_ops=shell.remote_ops)
+            shell.close()
+            local_path = os.path.join(root_path, 'read')
+            shell = ThrottledShell(cloud_path, local_path, latency=latency, bandwidth=bandwidth, workers=workers)
+            fpaths = [os.path.join(local_path, f) for f in fnames]
+            scenario['read_csv_cold'] = throughput(_measure(shell.read_csv, fpaths))
+            try:
+                import pyarrow
+                _measure(lambda fpath: shell.read_csv(fpath, cache=True), fpaths)
+                scenario['read_csv_cached'] = throughput(_measure(lambda fpath: shell.read_csv(fpath, cache=True), fpaths))
+            except ImportError:
+                pass
+            shell.close()
+        if verbose:
+            print('%s: sync %.1f MB/s (p95 %.1f ms), warm p95 %.2f ms, batch_sync %.1f MB/s, read_csv %.1f MB/s, peak %.1f MB' % (
+                '%ix%s' % (nfiles, _size_str(size)), scenario['sync_cold']['throughput_mb_s'], scenario['sync_cold']['p95_ms'], scenario['sync_warm']['p95_ms'],
+                scenario['batch_sync']['throughput_mb_s'], scenario['read_csv_cold']['throughput_mb_s'], max(v['peak_mb'] for v in scenario.values() if isinstance(v, dict))))
+    return results
+
+
+def _same_files(src_path, tgt_path, fnames):
+    for fname in fnames:
+        with open(os.path.join(src_path, fname), 'rb') as src_fd, open(os.path.join(tgt_path, fname), 'rb') as tgt_fd:
+            if src_fd.read() != tgt_fd.read(): return False
+    return True
+
+
+def bench_rclone(scenarios=SHELL_SCENARIOS[:2], rclone='rclone', workers=4, verbose=False):
+    # Check and time the rclone backend against a `:local:` remote: bulk pulls and pushes through `batch_sync`, lazy
+    # reads through `rclone cat`, and the fallback to the mounted path when rclone fails
+    if shutil.which(rclone) is None:
+        print('Skipped, %s is not on PATH.' % rclone)
+        return {}
+    results = {}
+    for nfiles, size in scenarios:
+        name = '%ix%s' % (nfiles, _size_str(size))
+        with tempfile.TemporaryDirectory() as root_path:
+            cloud_path, local_path = os.path.join(root_path, 'cloud'), os.path.join(root_path, 'local')
+            file_size = _write_csv_files(cloud_path, nfiles, size)
+            fnames = sorted(os.listdir(cloud_path))
+            scenario = results[name] = dict(files=nfiles, file_bytes=file_size)
+            shell = CloudShell(cloud_path, local_path, workers=workers, transfer=RcloneTransfer(':local:' + cloud_path, rclone=rclone))
+            start_time = time.perf_counter()
+            pulled = shell.batch_sync([os.path.join(local_path, f) for f in fnames])[0]
+            scenario['pull'] = dict(seconds=time.perf_counter() - start_time, ok=all(r['ok'] and r['action'] == 'pull' for r in pulled) and _same_files(cloud_path, local_path, fnames))
+            for fname in fnames:
+                with open(os.path.join(local_path, fname), 'a') as fd:
+                    fd.write('0,0,0,0,0,0,0,0\n')
+            start_time = time.perf_counter()
+            pushed = shell.batch_sync([os.path.join(local_path, f) for f in fnames])[0]
+            scenario['push'] = dict(seconds=time.perf_counter() - start_time, ok=all(r['ok'] and r['action'] == 'push' for r in pushed) and _same_files(local_path, cloud_path, fnames))
+            lazy_path = os.path.join(root_path, 'lazy')
+            lazy = CloudShell(cloud_path, lazy_path, transfer=shell.transfer)
+            start_time = time.perf_counter()
+            with lazy.open(os.path.join(lazy_path, fnames[0]), 'rb', lazy=True, block_size=64 << 10) as fd:
+                data = fd.read()
+            with open(os.path.join(cloud_path, fnames[0]), 'rb') as fd:
+                scenario['cat'] = dict(seconds=time.perf_counter() - start_time, ok=data == fd.read() and not os.path.exists(os.path.join(lazy_path, fnames[0])))
+            lazy.close()
+            shell.close()
+            # A failing rclone leaves the transfers to the mounted path
+            fallback_path = os.path.join(root_path, 'fallback')
+            shell = CloudShell(cloud_path, fallback_path, workers=workers, transfer=RcloneTransfer(':local:' + cloud_path, rclone=rclone, extra_args=['--no-such-flag']))
+            fallback = shell.batch_sync([os.path.join(fallback_path, f) for f in fnames])[0]
+            scenario['fallback'] = dict(ok=all(r['ok'] for r in fallback) and _same_files(cloud_path, fallback_path, fnames))
+            shell.close()
+        scenario['ok'] = all(scenario[k]['ok'] for k in ['pull', 'push', 'cat', 'fallback'])
+        if verbose: print('%s: pull %.2fs, push %.2fs, cat %.3fs, fallback %s%s' % (name, scenario['pull']['seconds'], scenario['push']['seconds'], scenario['cat']['seconds'],
+            'ok' if scenario['fallback']['ok'] else 'failed', '' if scenario['ok'] else ' [FAILED: %s]' % ', '.join(k for k in ['pull', 'push', 'cat', 'fallback'] if not scenario[k]['ok'])))
+    return results
+
+
+def _size_str(size):
+    for unit, shift in [('M', 20), ('K', 10)]:
+        if size >= 1 << shift: return '%i%s' % (size >> shift, unit)
+    return '%iB' % size
+
+
+def bench_gsheet(shapes=GSHEET_SHAPES, latency=0.0, chunk_cells=None, workers=1, repeat=3, verbose=False):
+    # Requests, latency and peak memory of `to_gsheet` (create and update) and `read_gsheet` (whole and paged) against the in-memory fakes
+    import numpy as np
+    import pandas as pd
+    from . import gdrive, fakes
+    results = {}
+    snapshot_dir = gdrive.GSHEET_SNAPSHOT_DIR
+    with tempfile.TemporaryDirectory() as root_path:
+        service = fakes.install(gdrive, root_path, service=fakes.FakeService(latency=latency))
+        gdrive.GSHEET_SNAPSHOT_DIR = os.path.join(root_path, 'snapshots')
+        try:
+            for nrows, ncols in shapes:
+                dataframe = pd.DataFrame(np.random.rand(nrows, ncols), columns=['c%i' % i for i in range(ncols)])
+                fpath = os.path.join(gdrive.DATA_ROOT_PATH, 'bench_%ix%i' % (nrows, ncols))
+                kwargs = dict(folder_id='', chunk_cells=chunk_cells or gdrive.GSHEET_CHUNK_CELLS, workers=workers)
+                gsheet_ids, shape = [], dict(cells=(nrows + 1) * (ncols + 1))
+                results['%ix%i' % (nrows, ncols)] = shape
+                def run(name, func):
+                    service.reset()
+                    shape[name] = _measure(func, range(repeat))
+                    shape[name]['requests'] = dict((k, v / float(repeat)) for k, v in service.requests.items())
+                run('write', lambda i: gsheet_ids.append(gdrive.to_gsheet(dataframe, fpath, **kwargs)))
+                gsheet_id = gsheet_ids[-1]
+                gdrive.save_snapshot(gsheet_id, gdrive.frame2values(dataframe, columns=dataframe.columns, index=True, index_label=None))
+                gmeta = gdrive.GMeta(os.path.join(root_path, 'gmeta.json'))
+                gmeta.add_spreadsheet(fpath + '.gsheet', gsheet_id)
+                updated = dataframe.copy()
+                def update(i):
+                    # Change about 1% of the cells each time
+                    updated.iloc[np.random.randint(0, nrows, max(1, nrows // 100)), i % ncols] += 1
+                    gdrive.to_gsheet(updated, fpath, mode='update', gmeta=gmeta, **dict(kwargs, folder_id=None))
+                run('update', update)
+                run('read', lambda i: gdrive.read_gsheet(gsheet_id=gsheet_id))
+                run('read_paged', lambda i: gdrive.read_gsheet(gsheet_id=gsheet_id, chunksize=max(1, nrows // 4)))
+                if verbose: print('%ix%i: ' % (nrows, ncols) + ', '.join('%s %.1f ms / %.0f requests' % (k, shape[k]['p50_ms'], shape[k]['requests'].get('total', 0)) for k in ['write', 'update', 'read', 'read_paged']))
+        finally:
+            gdrive.GSHEET_SNAPSHOT_DIR = snapshot_dir
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the dslib.cloud modules.')
+    parser.add_argument('suite', choices=['import', 'gsheet-write', 'gsheet', 'shell', 'rclone'], help='benchmark suite to run')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of repetitions')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of concurrent writers')
+    parser.add_argument('-l', '--latency', type=float, default=REMOTE_LATENCY * 1000, help='injected latency per remote operation (ms)')
+    parser.add_argument('-b', '--bandwidth', type=float, default=REMOTE_BANDWIDTH / float(1 << 20), help='bandwidth limit of the shell shim (MB/s), 0 for none')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+    if args.suite == 'import':
+        results = bench_import(repeat=args.repeat, verbose=True)
+    elif args.suite == 'gsheet-write':
+        results = bench_gsheet_write(workers=args.workers, verbose=True)
+    elif args.suite == 'gsheet':
+        results = bench_gsheet(latency=args.latency / 1000.0, workers=args.workers, repeat=args.repeat, verbose=True)
+    elif args.suite == 'shell':
+        results = bench_shell(latency=args.latency / 1000.0, bandwidth=int(args.bandwidth * (1 << 20)), workers=max(1, args.workers), verbose=True)
+    elif args.suite == 'rclone':
+        results = bench_rclone(workers=max(1, args.workers), verbose=True)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(dict(suite=args.suite, args=vars(args), environment=_environment(), results=results), fd, indent=4, sort_keys=True)
+    return 0 if all(r.get('ok', True) for r in results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+###########################################################################
+# Copyright (C) 2013-2022 by Caspar. All rights reserved.
+# File Name: blockio.py
+# Author: Shankai Yan
+# E-mail: dr.skyan@gmail.com
+# Created Time: 2022-02-17 16:12:45
+###########################################################################
+#
+
+import os, io, threading, collections
+from concurrent.futures import wait
+
+
+BLOCK_SIZE = 4 << 20
+READAHEAD = 2
+
+
+class BlockReader(io.RawIOBase):
+    # Seekable read-only view of a remote file, fetched in fixed-size blocks that are kept in `cache_dir`
+    # With `cache_limit`, the oldest blocks fetched by this reader are dropped once they take more than that many bytes.
+    def __init__(self, read_range, size, cache_dir, block_size=BLOCK_SIZE, readahead=READAHEAD, executor=None, on_close=None, cache_limit=None):
+        self.read_range = read_range
+        self.size = size
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        self.readahead = readahead
+        self.executor = executor
+        self.on_close = on_close
+        self.cache_limit = cache_limit
+        self.fetched = 0
+        self._cached = collections.OrderedDict()
+        self._cached_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._pos = 0
+        self._last_idx = None
+        self._current = (None, b'')
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('Invalid whence (%r)' % whence)
+        if pos < 0: raise ValueError('Negative seek position %i' % pos)
+        self._pos = pos
+        return pos
+
+    def _block_fpath(self, idx):
+        return os.path.join(self.cache_dir, '%08i.blk' % idx)
+
+    def _fetch(self, idx):
+        block_fpath = self._block_fpath(idx)
+        try:
+            with open(block_fpath, 'rb') as fd:
+                return fd.read()
+        except FileNotFoundError:
+            pass
+        offset = idx * self.block_size
+        data = self.read_range(offset, min(self.block_size, self.size - offset))
+        if data is None: raise IOError('Failed to read block %i of the remote file' % idx)
+        tmp_fpath = '%s.%i.tmp' % (block_fpath, threading.get_ident())
+        with open(tmp_fpath, 'wb') as fd:
+            fd.write(data)
+        os.replace(tmp_fpath, block_fpath)
+        with self._lock:
+            self.fetched += len(data)
+            self._cached[idx] = len(data)
+            self._cached_bytes += len(data)
+            while self.cache_limit is not None and self._cached_bytes > self.cache_limit and len(self._cached) > 1:
+                old_idx, old_size = self._cached.popitem(last=False)
+                self._cached_bytes -= old_size
+                try:
+                    os.remove(self._block_fpath(old_idx))
+                except FileNotFoundError:
+                    pass
+        return data
+
+    def _block(self, idx):
+        with self._lock:
+            future = self._inflight.get(idx)
+        if future is not None:
+            try:
+                return future.result()
+            finally:
+                with self._lock:
+                    self._inflight.pop(idx, None)
+        return self._fetch(idx)
+
+    def _prefetch(self, idx):
+        # Fetch the next blocks in the background once the access pattern looks sequential
+        if self.executor is None or not self.readahead: return
+        last_idx = (self.size - 1) // self.block_size
+        with self._lock:
+            for i in range(idx + 1, min(idx + self.readahead, last_idx) + 1):
+                if i not in self._inflight and not os.path.exists(self._block_fpath(i)):
+                    self._inflight[i] = self.executor.submit(self._fetch, i)
+
+    def readinto(self, b):
+        if self._pos >= self.size: return 0
+        idx, offset = divmod(self._pos, self.block_size)
+        if self._current[0] != idx:
+            self._current = (idx, self._block(idx))
+            if self._last_idx is not None and idx == self._last_idx + 1: self._prefetch(idx)
+            self._last_idx = idx
+        data = self._current[1]
+        n = min(len(b), len(data) - offset)
+        if n <= 0: return 0
+        b[:n] = data[offset:offset + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if self.closed: return
+        with self._lock:
+            running = [future for future in self._inflight.values() if not future.cancel()]
+            self._inflight.clear()
+        # Fetches already running still use the reader of `on_close`, wait for them before releasing it
+        wait(running)
+        super(BlockReader, self).close()
+        if self.on_close is not None: self.on_close()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+###########################################################################
+# Copyright (C) 2013-2022 by Caspar. All rights reserved.
+# File Name: fakes.py
+# Author: Shankai Yan
+# E-mail: dr.skyan@gmail.com
+# Created Time: 2022-02-21 15:03:26
+###########################################################################
+#
+
+import os, re, time, uuid, random, threading, collections
+
+
+GDRIVE_FOLDER_TYPE = 'application/vnd.google-apps.folder'
+GDRIVE_SPREADSHEET_TYPE = 'application/vnd.google-apps.spreadsheet'
+DEFAULT_SHEET_SHAPE = (1000, 26)
+
+
+def col2num(col):
+    num = 0
+    for c in col.upper(): num = num * 26 + ord(c) - ord('A') + 1
+    return num
+
+
+def a1_to_rect(range_name):
+    # 'B2:D5' or 'A1' -> (row, col, nrows, ncols), zero-based like `gdrive.rect2range`
+    m = re.match(r'^(?:[^!]*!)?([A-Za-z]+)(\d+)(?::([A-Za-z]+)(\d+))?$', range_name)
+    if m is None: raise ValueError('Unsupported range [%s]' % range_name)
+    row, col = int(m.group(2)) - 1, col2num(m.group(1)) - 1
+    if m.group(3) is None: return row, col, 1, 1
+    return row, col, int(m.group(4)) - row, col2num(m.group(3)) - col
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeAPIError(Exception):
+    # Mimics `gspread.exceptions.APIError`, the HTTP status is in `response.status_code`
+    def __init__(self, status_code, message=''):
+        super(FakeAPIError, self).__init__('%i %s' % (status_code, message))
+        self.response = FakeResponse(status_code)
+
+
+class FakeService(object):
+    # Request counters shared by the fake clients of one test or benchmark. Requests can be delayed by `latency` seconds
+    # and fail with `fault_status` at `fault_rate`, or with the statuses queued by `inject`.
+    def __init__(self, latency=0, fault_rate=0, fault_status=429, seed=None):
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.files = {}
+        self.spreadsheets = {}
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.fault_status = fault_status
+        self._faults = collections.deque()
+        self._random = random.Random(seed)
+
+    def inject(self, status, count=1):
+        with self.lock:
+            self._faults.extend([status] * count)
+
+    def request(self, name):
+        if self.latency: time.sleep(self.latency)
+        with self.lock:
+            self.requests[name] += 1
+            self.requests['total'] += 1
+            status = self._faults.popleft() if self._faults else (self.fault_status if self.fault_rate and self._random.random() < self.fault_rate else None)
+            if status is not None: self.requests['faults'] += 1
+        if status is not None: raise FakeAPIError(status, 'Injected fault on %s' % name)
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+
+
+class FakeWorksheet(object):
+    def __init__(self, service, spreadsheet, title='Sheet1', shape=DEFAULT_SHEET_SHAPE):
+        self.service = service
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self._row_count, self._col_count = shape
+        self._cells = {}
+
+    # Plain properties over the cached sheet properties, as in gspread
+    @property
+    def row_count(self):
+        return self._row_count
+
+    @property
+    def col_count(self):
+        return self._col_count
+
+    def _write(self, range_name, values):
+        row, col, nrows, ncols = a1_to_rect(range_name)
+        if row + len(values) > self.row_count or col + max([len(r) for r in values] or [0]) > self.col_count:
+            raise FakeAPIError(400, 'Range [%s] exceeds grid limits' % range_name)
+        for i, r in enumerate(values):
+            for j, v in enumerate(r):
+                if v is None or v == '':
+                    self._cells.pop((row + i, col + j), None)
+                else:
+                    self._cells[(row + i, col + j)] = v if isinstance(v, str) else str(v)
+
+    def _read(self, row, col, nrows, ncols):
+        nrows, ncols = min(nrows, self.row_count - row), min(ncols, self.col_count - col)
+        values = [[self._cells.get((row + i, col + j), '') for j in range(ncols)] for i in range(nrows)]
+        # Like the API, trailing empty cells and rows are not returned
+        values = [r[:max([j + 1 for j, v in enumerate(r) if v != ''] or [0])] for r in values]
+        while values and not values[-1]: values.pop()
+        return values
+
+    def update(self, range_name, values=None, **kwargs):
+        self.service.request('values.update')
+        if not isinstance(values, list): values = [[values]]
+        self._write(range_name, values)
+        return dict(updatedRange=range_name)
+
+    def batch_update(self, data, **kwargs):
+        self.service.request('values.batchUpdate')
+        for item in data: self._write(item['range'], item['values'])
+        return dict(totalUpdatedCells=sum(len(r) for item in data for r in item['values']))
+
+    def resize(self, rows=None, cols=None):
+        self.service.request('batchUpdate')
+        self._row_count = self._row_count if rows is None else rows
+        self._col_count = self._col_count if cols is None else cols
+        self._cells = dict((k, v) for k, v in self._cells.items() if k[0] < self.row_count and k[1] < self.col_count)
+
+    def add_rows(self, rows):
+        self.resize(rows=self.row_count + rows)
+
+    def get_all_values(self, **kwargs):
+        self.service.request('values.get')
+        return self._read(0, 0, self.row_count, self.col_count)
+
+    def get(self, range_name, **kwargs):
+        self.service.request('values.get')
+        return self._read(*a1_to_rect(range_name))
+
+    def batch_get(self, ranges, **kwargs):
+        self.service.request('values.batchGet')
+        return [self._read(*a1_to_rect(r)) for r in ranges]
+
+
+class FakeSpreadsheet(object):
+    def __init__(self, service, title, id=None):
+        self.service = service
+        self.title = title
+        self.id = id or uuid.uuid4().hex
+        self.worksheets_ = [FakeWorksheet(service, self)]
+
+    @property
+    def sheet1(self):
+        self.service.request('spreadsheets.get')
+        return self.worksheets_[0]
+
+    def get_worksheet(self, index):
+        self.service.request('spreadsheets.get')
+        return self.worksheets_[index] if index < len(self.worksheets_) else None
+
+    def worksheet(self, title):
+        self.service.request('spreadsheets.get')
+        for ws in self.worksheets_:
+            if ws.title == title: return ws
+        raise FakeAPIError(404, 'Worksheet [%s] not found' % title)
+
+    def add_worksheet(self, title, rows, cols):
+        self.service.request('batchUpdate')
+        self.worksheets_.append(FakeWorksheet(self.service, self, title=title, shape=(rows, cols)))
+        return self.worksheets_[-1]
+
+
+class FakeGSC(object):
+    # The part of `gspread.Client` used by `gdrive`
+    def __init__(self, service=None):
+        self.service = service or FakeService()
+
+    def create(self, title, folder_id=None):
+        self.service.request('files.create')
+        gsheet = FakeSpreadsheet(self.service, title)
+        with self.service.lock:
+            self.service.spreadsheets[gsheet.id] = gsheet
+            self.service.files[gsheet.id] = dict(id=gsheet.id, title=title, mimeType=GDRIVE_SPREADSHEET_TYPE, parents=[folder_id or ''])
+        return gsheet
+
+    def open_by_key(self, key):
+        self.service.request('spreadsheets.get')
+        if key not in self.service.spreadsheets: raise FakeAPIError(404, 'Spreadsheet [%s] not found' % key)
+        return self.service.spreadsheets[key]
+
+
+class FakeFileList(object):
+    def __init__(self, service, query):
+        self.service = service
+        self.query = query
+
+    def GetList(self):
+        self.service.request('files.list')
+        filters = dict((k, v) for v, k in re.findall(r"'((?:[^'\\]|\\.)*)' in (parents)", self.query))
+        filters.update((k, v) for k, v in re.findall(r"(title|mimeType) = '((?:[^'\\]|\\.)*)'", self.query))
+        filters = dict((k, re.sub(r'\\(.)', r'\1', v)) for k, v in filters.items())
+        with self.service.lock:
+            files = list(self.service.files.values())
+        return [dict(f) for f in files if all((v in f['parents']) if k == 'parents' else f.get(k) == v for k, v in filters.items())]
+
+
+class FakeGDrive(object):
+    # The part of `pydrive.drive.GoogleDrive` used by `gdrive`
+    def __init__(self, service=None):
+        self.service = service or FakeService()
+
+    def ListFile(self, param=None):
+        return FakeFileList(self.service, (param or {}).get('q', ''))
+
+    def add_folder(self, title, parent_id=''):
+        folder_id = uuid.uuid4().hex
+        with self.service.lock:
+            self.service.files[folder_id] = dict(id=folder_id, title=title, mimeType=GDRIVE_FOLDER_TYPE, parents=[parent_id])
+        return folder_id
+
+
+def install(gdrive, root_path, service=None, quotas=None):
+    # Point a `gdrive` module at in-memory clients and a local data root, return the shared service.
+    # With `quotas` (a (drive, sheets) pair of `gdrive.limit_client` quotas) the clients go through the rate-limited layer.
+    service = service or FakeService()
+    gdrive.GSC, gdrive.GDRIVE = FakeGSC(service), FakeGDrive(service)
+    if quotas is not None:
+        gdrive.GDRIVE, gdrive.GSC = gdrive.limit_client(gdrive.GDRIVE, quotas[0], backoff=0.01), gdrive.limit_client(gdrive.GSC, quotas[1], backoff=0.01)
+    gdrive.GDRIVE_ROOT_PATH = root_path
+    gdrive.GDRIVE_PATH = os.path.join(root_path, 'MyDrive')
+    gdrive.DATA_ROOT_PATH = os.path.join(gdrive.GDRIVE_PATH, 'notebooks/data')
+    gdrive.mkdir = lambda path: os.makedirs(path, exist_ok=True)
+    gdrive.RESOLVER.invalidate()
+    gdrive._READY = True
+    return service
@@ -9,74 +9,300 @@
 ###########################################################################
 #
 
-import os, json
-from google.colab import auth
-from google.colab import drive
-from oauth2client.client import GoogleCredentials
+import os, re, copy, json, time, threading, contextlib, collections
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
-from pydrive.auth import GoogleAuth
-from pydrive.drive import GoogleDrive
-
-import gspread
-import pandas as pd
-from openpyxl.utils.cell import get_column_letter
+from .ratelimit import TokenBucket, RateLimitedClient, is_retryable
+from .metrics import log, warn, count, instrument, bind
 
 
 GDRIVE_ROOT_PATH = '/content/gdrive'
-
-
-def mkdir(path):
-  if path and not os.path.exists(path):
-    print(("Creating folder: " + path))
-    os.makedirs(path)
-    drive.flush_and_unmount() # To be replace by drive.flush()
-    drive.mount(GDRIVE_ROOT_PATH)
-
-mkdir(GDRIVE_ROOT_PATH)
-auth.authenticate_user()
-drive.mount(GDRIVE_ROOT_PATH)
 GDRIVE_PATH = os.path.join(GDRIVE_ROOT_PATH, 'MyDrive')
 
 DATA_ROOT_PATH = os.path.join(GDRIVE_PATH, 'notebooks/data')
 DATA_ROOT_ID = ''
 
-gcred = GoogleCredentials.get_application_default()
-gauth = GoogleAuth()
-gauth.credentials = gcred
-GDRIVE = GoogleDrive(gauth)
 GDRIVE_FOLDER_TYPE = 'application/vnd.google-apps.folder'
 GDRIVE_SPREADSHEET_TYPE = 'application/vnd.google-apps.spreadsheet'
 
-GSC = gspread.authorize(gcred)
+# Sustained request rates (per second) and bursts of the per-user Drive and Sheets quotas
+DRIVE_QUOTA = dict(rate=10.0, capacity=20)
+SHEETS_QUOTA = dict(rate=1.0, capacity=10)
+
+# Clients created by `init()`, resolved lazily through the module `__getattr__`
+_CLIENTS = ('gcred', 'gauth', 'GDRIVE', 'GSC')
+_READY = False
+_INIT_LOCK = threading.Lock()
+
+
+def init():
+  # Authenticate, mount Google Drive and build the Drive/Sheets clients
+  global gcred, gauth, GDRIVE, GSC, _READY
+  from google.colab import auth
+  from google.colab import drive
+  from oauth2client.client import GoogleCredentials
+  from pydrive.auth import GoogleAuth
+  from pydrive.drive import GoogleDrive
+  import gspread
+  with _INIT_LOCK:
+    if _READY: return
+    if not os.path.isdir(GDRIVE_PATH):
+      os.makedirs(GDRIVE_ROOT_PATH, exist_ok=True)
+      auth.authenticate_user()
+      drive.mount(GDRIVE_ROOT_PATH)
+    else:
+      auth.authenticate_user()
+    gcred = GoogleCredentials.get_application_default()
+    gauth = GoogleAuth()
+    gauth.credentials = gcred
+    GDRIVE = limit_client(GoogleDrive(gauth), DRIVE_QUOTA)
+    GSC = limit_client(gspread.authorize(gcred), SHEETS_QUOTA)
+    _READY = True
+
+
+def limit_client(client, quota, retries=5, backoff=1.0):
+  # Throttle the client to the quota and retry rate-limit/transient errors with backoff
+  return RateLimitedClient(client, TokenBucket(**quota), retries=retries, backoff=backoff)
+
+
+def api_stats():
+  # Calls, throttled waits, retries and failures of the Drive and Sheets clients
+  return dict((k, c._stats.to_dict()) for k, c in [('drive', globals().get('GDRIVE')), ('sheets', globals().get('GSC'))] if isinstance(c, RateLimitedClient))
+
+
+def ensure_ready():
+  if not _READY: init()
+
+
+def __getattr__(name):
+  if name in _CLIENTS:
+    ensure_ready()
+    return globals()[name]
+  raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def mkdir(path):
+  if path and not os.path.exists(path):
+    from google.colab import drive
+    log(("Creating folder: " + path))
+    os.makedirs(path)
+    drive.flush_and_unmount() # To be replace by drive.flush()
+    drive.mount(GDRIVE_ROOT_PATH)
+
 
 GMETA_TEMPLATE = {'spreadsheet':{}}
 
 
 class GMeta(object):
+  # Path to sheet ID store kept as an append-only log of JSON lines `[section, key, value]` in `meta_fpath`, compacted on load.
+  # Writers take an exclusive lock on `<meta_fpath>.lock`, entries appended by other processes are picked up before every lookup.
+  # A file in the legacy format (one JSON document like `GMETA_TEMPLATE`) is imported and rewritten as a log.
   def __init__(self, meta_fpath):
     self.meta_fpath = meta_fpath
-    if not os.path.exists(meta_fpath):
-      self.meta_dict = GMETA_TEMPLATE
-      self.flush()
-    else:
-      with open(meta_fpath, 'r') as fd:
-        self.meta_dict = json.load(fd)
+    self.meta_dict = copy.deepcopy(GMETA_TEMPLATE)
+    self._offset, self._inode = 0, None
+    self._pending, self._depth = None, 0
+    self._lock = threading.RLock()
+    with self._locked():
+      if os.path.exists(meta_fpath):
+        nlines = self._load()
+        if nlines > sum(len(v) for v in self.meta_dict.values()): self._compact()
+      else:
+        self._compact()
+
+  @contextlib.contextmanager
+  def _locked(self):
+    with self._lock:
+      with open(self.meta_fpath + '.lock', 'a') as lock_fd:
+        if fcntl is not None: fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+          yield
+        finally:
+          if fcntl is not None: fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+  def _apply(self, line):
+    section, key, value = json.loads(line)
+    self.meta_dict.setdefault(section, {})[key] = value
+
+  def _load(self):
+    # Read the log from the last offset, or from the start if it has been compacted since. Return the number of lines read.
+    try:
+      stat = os.stat(self.meta_fpath)
+    except FileNotFoundError:
+      return 0
+    if stat.st_ino != self._inode:
+      self.meta_dict, self._offset, self._inode = copy.deepcopy(GMETA_TEMPLATE), 0, stat.st_ino
+    if stat.st_size <= self._offset: return 0
+    with open(self.meta_fpath, 'r') as fd:
+      fd.seek(self._offset)
+      content = fd.read()
+    if self._offset == 0 and content.lstrip().startswith('{'):
+      self.import_json(json.loads(content) if content.strip() else {}, write=False)
+      self._offset = len(content.encode('utf-8'))
+      return float('inf')
+    # Ignore a partial last line, it is read again once complete
+    content = content[:content.rfind('\n') + 1]
+    lines = [l for l in content.splitlines() if l.strip()]
+    for line in lines: self._apply(line)
+    self._offset += len(content.encode('utf-8'))
+    return len(lines)
+
+  def _compact(self):
+    # Rewrite the log with one line per entry
+    tmp_fpath = '%s.%i.tmp' % (self.meta_fpath, os.getpid())
+    with open(tmp_fpath, 'w') as fd:
+      for section, entries in sorted(self.meta_dict.items()):
+        for key, value in sorted(entries.items()): fd.write(json.dumps([section, key, value]) + '\n')
+    os.replace(tmp_fpath, self.meta_fpath)
+    stat = os.stat(self.meta_fpath)
+    self._offset, self._inode = stat.st_size, stat.st_ino
+
+  def _append(self, entries):
+    with self._locked():
+      self._load()
+      with open(self.meta_fpath, 'a') as fd:
+        fd.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+      for section, key, value in entries: self.meta_dict.setdefault(section, {})[key] = value
+      self._offset = os.stat(self.meta_fpath).st_size
+
+  def _put(self, section, key, value):
+    with self._lock:
+      if self._pending is not None:
+        self._pending.append([section, key, value])
+        self.meta_dict.setdefault(section, {})[key] = value
+        return
+    self._append([[section, key, value]])
+
+  @contextlib.contextmanager
+  def batch(self):
+    # Buffer the additions made in the block, from any thread, and append them with one locked write on exit
+    with self._lock:
+      self._depth += 1
+      if self._pending is None: self._pending = []
+    try:
+      yield self
+    finally:
+      with self._lock:
+        self._depth -= 1
+        entries = None
+        if not self._depth: entries, self._pending = self._pending, None
+        if entries: self._append(entries)
+
   def get_spreadsheet(self, fpath):
     dir_path, gs_name = os.path.split(fpath)
     gs_name = os.path.splitext(gs_name)[0]
     fpath = os.path.join(dir_path, '%s.gsheet' % gs_name)
-    return self.meta_dict['spreadsheet'][fpath] if fpath in self.meta_dict['spreadsheet'] else None
+    with self._lock:
+      if self._pending is None:
+        with self._locked():
+          self._load()
+      return self.meta_dict['spreadsheet'].get(fpath)
+
   def add_spreadsheet(self, fpath, gsheet_id):
-    self.meta_dict['spreadsheet'][fpath] = gsheet_id
-    self.flush()
+    self._put('spreadsheet', fpath, gsheet_id)
+
+  def import_json(self, meta, write=True):
+    # Merge a legacy meta dict, or the path of a legacy JSON file
+    if isinstance(meta, str):
+      with open(meta, 'r') as fd:
+        meta = json.load(fd)
+    entries = [[section, key, value] for section, items in meta.items() for key, value in items.items()]
+    if not write:
+      for section, key, value in entries: self.meta_dict.setdefault(section, {})[key] = value
+    elif entries:
+      with self.batch():
+        for entry in entries: self._put(*entry)
+
   def flush(self, **kwargs):
-    kw_args = dict(sort_keys=True, indent=4, separators=(',', ': '))
-    kw_args.update(kwargs)
-    with open(self.meta_fpath, mode='w') as fd:
-      fd.write(json.dumps(self.meta_dict, **kw_args))
+    # Compact the log
+    with self._locked():
+      self._load()
+      self._compact()
+
+
+def _quote(value):
+  return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+class DriveResolver(object):
+  # Resolve data paths to Drive folder IDs and (folder, title) to sheet IDs with filtered queries, caching the answers with TTL/LRU
+  def __init__(self, ttl=600, maxsize=4096):
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self._cache = collections.OrderedDict()
+    self._lock = threading.Lock()
+  def _get(self, key):
+    with self._lock:
+      item = self._cache.get(key)
+      if item is not None and self.ttl is not None and item[1] < time.time():
+        del self._cache[key]
+        item = None
+      if item is None:
+        count(cache_misses=1)
+        return None
+      self._cache.move_to_end(key)
+      count(cache_hits=1)
+      return item[0]
+  def _set(self, key, value):
+    with self._lock:
+      self._cache[key] = (value, time.time() + (self.ttl or 0))
+      self._cache.move_to_end(key)
+      while len(self._cache) > self.maxsize: self._cache.popitem(last=False)
+  def invalidate(self, key=None):
+    with self._lock:
+      if key is None:
+        self._cache.clear()
+      else:
+        self._cache.pop(key, None)
+  def query(self, parent_id, title, mime_type):
+    files = GDRIVE.ListFile({'q': "'%s' in parents and title = '%s' and mimeType = '%s' and trashed = false" % (parent_id, _quote(title), mime_type)}).GetList()
+    return files[0]['id'] if len(files) > 0 else None
+  def folder_id(self, dir_path, use_cache=True):
+    rel_nodes = [n for n in dir_path[len(DATA_ROOT_PATH):].strip('/').split('/') if n]
+    search_folder_id, cached_keys = DATA_ROOT_ID, []
+    for i in range(len(rel_nodes)):
+      key = ('folder', '/'.join(rel_nodes[:i+1]))
+      folder_id = self._get(key) if use_cache else None
+      if folder_id is not None:
+        cached_keys.append(key)
+      else:
+        folder_id = self.query(search_folder_id, rel_nodes[i], GDRIVE_FOLDER_TYPE)
+        if folder_id is None:
+          # A cached parent may be stale, drop it and look the path up again
+          if cached_keys:
+            for k in cached_keys: self.invalidate(k)
+            return self.folder_id(dir_path, use_cache=False)
+          return None
+        self._set(key, folder_id)
+      search_folder_id = folder_id
+    return search_folder_id
+  def sheet_id(self, folder_id, title, use_cache=True):
+    key = ('sheet', folder_id, title)
+    sheet_id = self._get(key) if use_cache else None
+    if sheet_id is None:
+      sheet_id = self.query(folder_id, title, GDRIVE_SPREADSHEET_TYPE)
+      if sheet_id is not None: self._set(key, sheet_id)
+    return sheet_id
+
+RESOLVER = DriveResolver()
+
 
+GSHEET_CHUNK_CELLS = 50000
+GSHEET_SNAPSHOT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dslib', 'gsheet')
+
+
+def fix_dir_path(dir_path):
+  # Map a directory outside the data root onto the data root
+  if dir_path.startswith(DATA_ROOT_PATH): return dir_path
+  fpath_nodes = dir_path.strip('/').split('/')
+  default_nodes = set(DATA_ROOT_PATH.strip('/').split('/'))
+  return '/'.join([DATA_ROOT_PATH] + [n for n in fpath_nodes[:len(default_nodes)] if n not in default_nodes] + fpath_nodes[len(default_nodes):])
 
 def rect2range(rect):
+  from openpyxl.utils.cell import get_column_letter
   return '%s%i:%s%i' % (get_column_letter(rect[1]+1), rect[0]+1, get_column_letter(rect[1]+rect[3]), rect[0]+rect[2])
 
 def get_gsheet(gsheet, sheet='sheet1'):
@@ -86,122 +312,225 @@ def get_gsheet(gsheet, sheet='sheet1'):
     try:
       worksheet = gsheet.worksheet(sheet)
     except Exception as e:
+      if is_retryable(e): raise
       worksheet = gsheet.sheet1
   else:
     worksheet = gsheet.sheet1
   return worksheet
 
-def to_gsheet(dataframe, fpath=None, folder_id=None, sheet='sheet1', columns=None, header=True, index=True, index_label=None, gmeta=None):
+def frame2values(dataframe, columns=None, index=False, index_label=None):
+  # Header row (if `columns`), index column (if `index`) and body as one list of rows, missing values become empty cells
+  body = dataframe.astype(object).where(dataframe.notna(), '').values.tolist()
+  if index:
+    body = [[idx] + row for idx, row in zip(dataframe.index.tolist(), body)]
+  if columns is not None:
+    body.insert(0, ([index_label if index_label is not None else ''] if index else []) + list(columns))
+  return body
+
+def write_values(worksheet, values, row=0, col=0, chunk_cells=GSHEET_CHUNK_CELLS, workers=1, resize=True):
+  # Write the grid in one request, or in row chunks of at most `chunk_cells` cells (in parallel with `workers`) after a single resize. Return the number of write requests.
+  nrows, ncols = len(values), max([len(r) for r in values] or [0])
+  if nrows == 0 or ncols == 0: return 0
+  if resize and (worksheet.row_count, worksheet.col_count) != (row + nrows, col + ncols):
+    worksheet.resize(rows=row + nrows, cols=col + ncols)
+  chunk_rows = max(1, chunk_cells // ncols)
+  if nrows <= chunk_rows:
+    worksheet.update(rect2range((row, col, nrows, ncols)), values)
+    return 1
+  chunks = [(rect2range((row + i, col, len(values[i:i+chunk_rows]), ncols)), values[i:i+chunk_rows]) for i in range(0, nrows, chunk_rows)]
+  if workers > 1:
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      list(executor.map(bind(lambda chunk: worksheet.update(*chunk)), chunks))
+  else:
+    for chunk in chunks: worksheet.update(*chunk)
+  return len(chunks)
+
+def _cell_str(value):
+  if value is None: return ''
+  if isinstance(value, bool): return 'TRUE' if value else 'FALSE'
+  return value if isinstance(value, str) else str(value)
+
+def _snapshot_fpath(gsheet_id, sheet):
+  return os.path.join(GSHEET_SNAPSHOT_DIR, '%s-%s.json' % (gsheet_id, sheet))
+
+def load_snapshot(gsheet_id, sheet='sheet1'):
+  try:
+    with open(_snapshot_fpath(gsheet_id, sheet), 'r') as fd:
+      return json.load(fd)
+  except (IOError, ValueError) as e:
+    return None
+
+def save_snapshot(gsheet_id, values, sheet='sheet1'):
+  os.makedirs(GSHEET_SNAPSHOT_DIR, exist_ok=True)
+  tmp_fpath = _snapshot_fpath(gsheet_id, sheet) + '.tmp'
+  with open(tmp_fpath, 'w') as fd:
+    json.dump([[_cell_str(v) for v in row] for row in values], fd)
+  os.replace(tmp_fpath, _snapshot_fpath(gsheet_id, sheet))
+
+def diff_values(old_values, new_values):
+  # Rectangles (row, col, nrows, ncols) covering the cells of `new_values` that differ from `old_values`
+  runs = []
+  for i, row in enumerate(new_values):
+    old_row = old_values[i] if i < len(old_values) else []
+    j = 0
+    while j < len(row):
+      if _cell_str(row[j]) == (old_row[j] if j < len(old_row) else ''):
+        j += 1
+        continue
+      k = j
+      while k < len(row) and _cell_str(row[k]) != (old_row[k] if k < len(old_row) else ''): k += 1
+      runs.append((i, j, k - j))
+      j = k
+  # Merge the same column runs of consecutive rows
+  rects, open_rects = [], {}
+  for i, j, n in runs:
+    rect = open_rects.get((j, n))
+    if rect is not None and rect[0] + rect[2] == i:
+      rect[2] += 1
+    else:
+      rect = open_rects[(j, n)] = [i, j, 1, n]
+      rects.append(rect)
+  return [tuple(r) for r in rects]
+
+def update_values(worksheet, values, old_values=None, chunk_cells=GSHEET_CHUNK_CELLS):
+  # Send only the changed cell ranges (against `old_values`, or the current sheet contents) and resize the sheet to the new shape. Return the number of changed cells.
+  # A snapshot is only trusted while the sheet keeps the shape it was written with (the grid is resized to it below),
+  # otherwise the sheet was changed elsewhere and its contents are read back
+  if old_values is not None and (worksheet.row_count, worksheet.col_count) != (len(old_values), max([len(r) for r in old_values] or [0])): old_values = None
+  if old_values is None: old_values = worksheet.get_all_values()
+  nrows, ncols = len(values), max([len(r) for r in values] or [0])
+  if nrows > worksheet.row_count or ncols > worksheet.col_count:
+    worksheet.resize(rows=max(nrows, worksheet.row_count), cols=max(ncols, worksheet.col_count))
+  data, ncells, changed = [], 0, 0
+  for row, col, n, m in diff_values(old_values, values):
+    data.append(dict(range=rect2range((row, col, n, m)), values=[r[col:col+m] for r in values[row:row+n]]))
+    ncells += n * m
+    changed += n * m
+    if ncells >= chunk_cells:
+      worksheet.batch_update(data)
+      data, ncells = [], 0
+  if data: worksheet.batch_update(data)
+  if (worksheet.row_count, worksheet.col_count) != (nrows, ncols):
+    worksheet.resize(rows=nrows, cols=ncols)
+  return changed
+
+@instrument('gsheet.write')
+def to_gsheet(dataframe, fpath=None, folder_id=None, sheet='sheet1', columns=None, header=True, index=True, index_label=None, gmeta=None, chunk_cells=GSHEET_CHUNK_CELLS, workers=1, mode='create'):
+  ensure_ready()
   if fpath is None:
     fpath = os.path.join(DATA_PATH, 'new_spreadsheet')
   dir_path, gs_name = os.path.split(fpath)
   # Fix directory prefix
-  if not dir_path.startswith(DATA_ROOT_PATH):
-    fpath_nodes = dir_path.strip('/').split('/')
-    default_nodes = set(DATA_ROOT_PATH.strip('/').split('/'))
-    dir_path = '/'.join([DATA_ROOT_PATH] + [n for n in fpath_nodes[:len(default_nodes)] if n not in default_nodes] + fpath_nodes[len(default_nodes):])
+  dir_path = fix_dir_path(dir_path)
   gs_name = os.path.splitext(gs_name)[0]
   fpath = os.path.join(dir_path, '%s.gsheet' % gs_name)
   mkdir(dir_path)
   found_folder_id = folder_id
   # Find the folder ID
   if folder_id is None:
-    rel_nodes = dir_path[len(DATA_ROOT_PATH):].strip('/').split('/')
-    search_folder_id = DATA_ROOT_ID
-    while len(rel_nodes) > 0:
+    found_folder_id = RESOLVER.folder_id(dir_path)
+    if found_folder_id is None: warn('Path [%s] not found!' % dir_path)
+  # Get worksheet, in `update` mode reuse the recorded sheet
+  gsheet = None
+  if mode == 'update':
+    gsheet_id = gmeta.get_spreadsheet(fpath) if gmeta is not None else None
+    if gsheet_id is None and found_folder_id is not None: gsheet_id = RESOLVER.sheet_id(found_folder_id, gs_name)
+    if gsheet_id is not None:
       try:
-        search_folder_id = next(f for f in GDRIVE.ListFile({'q': "'%s' in parents" % search_folder_id}).GetList() if f['mimeType'] == GDRIVE_FOLDER_TYPE and f['title'] == rel_nodes[0])['id']
+        gsheet = GSC.open_by_key(gsheet_id)
       except Exception as e:
-        print('Path [%s] not found!' % dir_path)
-        break
-      del rel_nodes[0]
-    else:
-      found_folder_id = search_folder_id
-  # Get worksheet
-  gsheet = GSC.create(gs_name, folder_id=found_folder_id)
+        if is_retryable(e): raise
+        warn('Cannot open the sheet %s, creating a new one!' % gsheet_id)
+  updating = gsheet is not None
+  if not updating: gsheet = GSC.create(gs_name, folder_id=found_folder_id)
   worksheet = get_gsheet(gsheet, sheet=sheet)
 
-  # Determine the range of sheet columns, index, data and update the values
+  # Determine the sheet columns, index and data as one grid
   if header:
     columns = dataframe.columns if columns is None else columns
   if index:
     index_label = dataframe.index.name if index_label is None else index_label
-  if header and index:
-    worksheet.update('A1', index_label)
-    worksheet.update(rect2range((0, 1, 1, len(columns))), [columns.tolist()])
-    worksheet.update(rect2range((1, 0, len(dataframe.index), 1)), [[idx] for idx in dataframe.index])
-    rect = (1, 1) + dataframe.shape
-  elif header:
-    worksheet.update(rect2range((0, 0, 1, len(columns))), [columns.tolist()])
-    rect = (1, 0) + dataframe.shape
-  elif index:
-    worksheet.update('A1', index_label)
-    worksheet.update(rect2range((1, 0, len(dataframe.index), 1)), [[idx] for idx in dataframe.index])
-    rect = (0, 1) + dataframe.shape
+  values = frame2values(dataframe, columns=columns if header else None, index=index, index_label=index_label)
+  count(cells=sum(len(r) for r in values))
+  if updating:
+    changed = update_values(worksheet, values, old_values=load_snapshot(gsheet.id, sheet=sheet), chunk_cells=chunk_cells)
+    log('Updated %i cells' % changed)
   else:
-    rect = (0, 0) + dataframe.shape
-  worksheet.update(rect2range(rect), dataframe.values.tolist())
-  print('Saved to %s' % ((GDRIVE_PATH if found_folder_id is None else 'fpath: [%s]' % fpath) if folder_id is None else 'Folder ID: %s' % folder_id))
+    write_values(worksheet, values, chunk_cells=chunk_cells, workers=workers)
+  if mode == 'update': save_snapshot(gsheet.id, values, sheet=sheet)
+  log('Saved to %s' % ((GDRIVE_PATH if found_folder_id is None else 'fpath: [%s]' % fpath) if folder_id is None else 'Folder ID: %s' % folder_id))
   if folder_id is None and gmeta is not None:
     try:
       gmeta.add_spreadsheet(fpath, worksheet.spreadsheet.id)
     except Exception as e:
-      print(e)
+      warn(e)
   return worksheet.spreadsheet.id
 
 
-def read_gsheet(fpath=None, gsheet_id=None, sheet='sheet1', header=True, names=None, index_col=None, usecols=None, dtype=None, gmeta=None):
+@instrument('gsheet.read')
+def read_gsheet(fpath=None, gsheet_id=None, sheet='sheet1', header=True, names=None, index_col=None, usecols=None, dtype=None, gmeta=None, chunksize=None, iterator=False):
+  import pandas as pd
+  ensure_ready()
   worksheet = None
   # Get worksheet
   if fpath is None and gsheet_id is None:
-    print('Please input a correct file path or sheet ID!')
+    warn('Please input a correct file path or sheet ID!')
     return None
   elif gsheet_id is not None:
     try:
       gsheet = GSC.open_by_key(gsheet_id)
       worksheet = get_gsheet(gsheet, sheet=sheet)
     except Exception as e:
+      if is_retryable(e): raise
       if fpath is None:
-        print('Inexisted sheet ID: %s' % gsheet_id)
+        warn('Inexisted sheet ID: %s' % gsheet_id)
         return None
   if worksheet is None:
     dir_path, gs_name = os.path.split(fpath)
     # Fix directory prefix
     if not dir_path.startswith(DATA_ROOT_PATH):
-      print('Path [%s] is not within the data root path [%s]. Trying to load from the data root path. Next time consider inputting the sheet ID instead!' % (fpath, DATA_ROOT_PATH))
-      fpath_nodes = dir_path.strip('/').split('/')
-      default_nodes = set(DATA_ROOT_PATH.strip('/').split('/'))
-      dir_path = '/'.join([DATA_ROOT_PATH] + [n for n in fpath_nodes[:len(default_nodes)] if n not in default_nodes] + fpath_nodes[len(default_nodes):])
+      warn('Path [%s] is not within the data root path [%s]. Trying to load from the data root path. Next time consider inputting the sheet ID instead!' % (fpath, DATA_ROOT_PATH))
+      dir_path = fix_dir_path(dir_path)
     gs_name = os.path.splitext(gs_name)[0]
     fpath = os.path.join(dir_path, '%s.gsheet' % gs_name)
     if not os.path.exists(fpath):
-      print('File path [%s] cannot be found!' % fpath)
+      warn('File path [%s] cannot be found!' % fpath)
+      return None
+    found_folder_id = RESOLVER.folder_id(dir_path)
+    if found_folder_id is None:
+      warn('Path [%s] not found!' % dir_path)
+      return None
+    gsheet_id = RESOLVER.sheet_id(found_folder_id, gs_name)
+    if gsheet_id is None:
+      warn('Sheet [%s] is not found in the path [%s]!' % (gs_name, dir_path))
       return None
-    rel_nodes = dir_path[len(DATA_ROOT_PATH):].strip('/').split('/')
-    search_folder_id, found_folder_id = DATA_ROOT_ID, None
-    while len(rel_nodes) > 0:
-      try:
-        search_folder_id = next(f for f in GDRIVE.ListFile({'q': "'%s' in parents" % search_folder_id}).GetList() if f['mimeType'] == GDRIVE_FOLDER_TYPE and f['title'] == rel_nodes[0])['id']
-      except Exception as e:
-        print('Path [%s] not found!' % dir_path)
-        return None
-      del rel_nodes[0]
-    else:
-      found_folder_id = search_folder_id
     try:
-        gsheet_id = next(f for f in GDRIVE.ListFile({'q': "'%s' in parents" % found_folder_id}).GetList() if f['mimeType'] == GDRIVE_SPREADSHEET_TYPE and f['title'] == gs_name)['id']
+      gsheet = GSC.open_by_key(gsheet_id)
     except Exception as e:
-      print('Sheet [%s] is not found in the path [%s]!' % (gs_name, dir_path))
-      return None
+      if is_retryable(e): raise
+      # The cached sheet ID may be stale
+      RESOLVER.invalidate(('sheet', found_folder_id, gs_name))
+      gsheet_id = RESOLVER.sheet_id(found_folder_id, gs_name, use_cache=False)
+      if gsheet_id is None:
+        warn('Sheet [%s] is not found in the path [%s]!' % (gs_name, dir_path))
+        return None
+      gsheet = GSC.open_by_key(gsheet_id)
     if gmeta is not None:
       try:
         gmeta.add_spreadsheet(fpath, gsheet_id)
       except Exception as e:
-        print(e)
-    gsheet = GSC.open_by_key(gsheet_id)
+        warn(e)
     worksheet = get_gsheet(gsheet, sheet=sheet)
 
+  if chunksize or usecols or iterator:
+    pages = read_pages(worksheet, header=header, names=names, index_col=index_col, usecols=usecols, dtype=dtype, chunksize=chunksize)
+    if iterator: return pages
+    pages = list(pages)
+    count(cells=sum(page.size for page in pages))
+    return pd.concat(pages) if len(pages) > 1 else (pages[0] if pages else pd.DataFrame())
   sheet_values = worksheet.get_all_values()
+  count(cells=sum(len(r) for r in sheet_values))
   if header:
     if sheet_values[0][0] == '':
       sheet_values[0][0] = '_index'
@@ -216,21 +545,168 @@ def read_gsheet(fpath=None, gsheet_id=None, sheet='sheet1', header=True, names=N
   if usecols:
     dataframe = dataframe[usecols]
   if dtype:
-    for k, v in dtype.items():
-      try:
-        dataframe[k] = dataframe[k].astype(v)
-      except Exception as e:
-        print('Cannot set the dtype of column %s as %s!' % (k, v))
+    dataframe = astype(dataframe, dtype)
   return dataframe
 
 
-def batch_pd2gsh(dir_path, read_kwargs={}, write_kwargs={}):
-    if not os.path.exists(dir_path): return []
-    return [to_gsheet(pd.read_csv(os.path.join(dir_path, fname), **read_kwargs), os.splitext(fname)[0], **write_kwargs) for fname in fs.listf(dir_path, pattern='.*\.csv', ret_fullpath=False)]
+def astype(dataframe, dtype):
+  # Convert the string cells column-wise: numeric and datetime columns are parsed in one vectorized pass with empty cells as missing values
+  import pandas as pd
+  others = {}
+  for k, v in dtype.items():
+    if k not in dataframe.columns:
+      warn('Cannot set the dtype of column %s as %s!' % (k, v))
+      continue
+    try:
+      kind = pd.api.types.pandas_dtype(v).kind
+    except TypeError:
+      kind = None
+    try:
+      if kind in ('i', 'u', 'f', 'M'):
+        # Empty cells become missing values, malformed cells too but with a warning
+        values = pd.to_datetime(dataframe[k], errors='coerce') if kind == 'M' else pd.to_numeric(dataframe[k], errors='coerce')
+        malformed = int((values.isna() & dataframe[k].notna() & (dataframe[k] != '')).sum())
+        if malformed: warn('Cannot set the dtype of %i cells of column %s as %s, they are kept as missing values!' % (malformed, k, v))
+        if kind in ('i', 'u') and values.isna().any():
+          warn('Column %s has missing values and is kept as float instead of %s!' % (k, v))
+        elif kind != 'M':
+          values = values.astype(v)
+        dataframe[k] = values
+      else:
+        others[k] = v
+    except Exception as e:
+      warn('Cannot set the dtype of column %s as %s!' % (k, v))
+  if others:
+    try:
+      dataframe = dataframe.astype(others)
+    except Exception as e:
+      for k, v in others.items():
+        try:
+          dataframe[k] = dataframe[k].astype(v)
+        except Exception as e:
+          warn('Cannot set the dtype of column %s as %s!' % (k, v))
+  return dataframe
 
 
-def batch_gsh2pd(dir_path=None, gsheet_ids=None, read_kwargs={}, write_kwargs={}):
-    return [read_gsheet(os.path.join(dir_path, fname), **read_gsheet).to_csv('%s.csv'%os.splitext(fname)[0]) for fname in fs.listf(dir_path, pattern='.*\.gsheet', ret_fullpath=False)]
+def read_pages(worksheet, header=True, names=None, index_col=None, usecols=None, dtype=None, chunksize=None):
+  # Yield DataFrame chunks of `chunksize` rows. Only the columns needed by `usecols` and `index_col` are requested.
+  # The pages walk the grid (`row_count`) and short blocks are padded, as the API drops the trailing empty rows of a range.
+  # Blank pages are held back and the trailing blank rows dropped, so that the rows end where `get_all_values` ends.
+  # Without `index_col`, the index continues across the pages.
+  import pandas as pd
+  if header:
+    columns = (worksheet.get(rect2range((0, 0, 1, worksheet.col_count))) or [[]])[0]
+    if columns and columns[0] == '':
+      columns[0] = '_index'
+      index_col = index_col if index_col else '_index'
+    columns = columns if names is None else list(names)
+    start_row = 1
+  else:
+    columns = list(range(worksheet.col_count)) if names is None else list(names)
+    start_row = 0
+  selected = range(len(columns))
+  if usecols:
+    keys = ([usecols] if isinstance(usecols, str) else list(usecols)) + ([] if not index_col else [index_col] if isinstance(index_col, str) else list(index_col))
+    selected = sorted(set(columns.index(k) for k in keys if k in columns))
+  # Contiguous column spans, one range per span and page
+  spans = []
+  for j in selected:
+    if spans and spans[-1][0] + spans[-1][1] == j:
+      spans[-1][1] += 1
+    else:
+      spans.append([j, 1])
+  def to_frame(row, records):
+    dataframe = pd.DataFrame.from_records(records, columns=[columns[j] for j in selected])
+    if index_col:
+      dataframe = dataframe.set_index(index_col)
+    else:
+      dataframe.index = pd.RangeIndex(row - start_row, row - start_row + len(records))
+    if usecols:
+      dataframe = dataframe[usecols]
+    if dtype:
+      dataframe = astype(dataframe, dtype)
+    return dataframe
+  # The pages read since the last one with data, the first of them is the last page with data
+  held = []
+  page_size = chunksize or max(1, worksheet.row_count - start_row)
+  for row in range(start_row, worksheet.row_count, page_size):
+    nrows = min(page_size, worksheet.row_count - row)
+    blocks = worksheet.batch_get([rect2range((row, j, nrows, n)) for j, n in spans]) if spans else []
+    records = [sum([(b[i] if i < len(b) else []) + [''] * (n - len(b[i] if i < len(b) else [])) for (j, n), b in zip(spans, blocks)], []) for i in range(nrows)]
+    if not any(any(v != '' for v in r) for r in records):
+      if held: held.append((row, records))
+      continue
+    for page in held: yield to_frame(*page)
+    held = [(row, records)]
+  if held:
+    row, records = held[0]
+    while records and not any(v != '' for v in records[-1]): records.pop()
+    yield to_frame(row, records)
+
+
+def _listdir(dir_path, pattern):
+  regex = re.compile(pattern)
+  return sorted(entry.name for entry in os.scandir(dir_path) if entry.is_file() and regex.match(entry.name))
+
+
+def batch_pd2gsh(dir_path, pattern=r'.*\.csv$', gsheet_dir=None, read_kwargs={}, write_kwargs={}, workers=4, api_workers=2):
+  # Parse the CSV files on a worker pool and upload them with at most `api_workers` concurrent sheet writes. Return one status per file.
+  import pandas as pd
+  if not os.path.exists(dir_path): return []
+  ensure_ready()
+  gsheet_dir = dir_path if gsheet_dir is None else gsheet_dir
+  # Resolve the target folder once for the whole batch
+  if 'folder_id' not in write_kwargs:
+    mkdir(fix_dir_path(gsheet_dir))
+    RESOLVER.folder_id(fix_dir_path(gsheet_dir))
+  api_slots = threading.BoundedSemaphore(max(1, api_workers))
+  def convert(fname):
+    status = dict(fpath=os.path.join(dir_path, fname), gsheet_id=None, ok=False)
+    try:
+      dataframe = pd.read_csv(status['fpath'], **read_kwargs)
+      with api_slots:
+        status['gsheet_id'] = to_gsheet(dataframe, os.path.join(gsheet_dir, os.path.splitext(fname)[0]), **write_kwargs)
+      status['ok'] = True
+    except Exception as e:
+      warn('Failed to convert [%s]: %s' % (status['fpath'], e))
+      status['error'] = str(e)
+    return status
+  from concurrent.futures import ThreadPoolExecutor
+  gmeta = write_kwargs.get('gmeta')
+  with (gmeta.batch() if gmeta is not None else contextlib.nullcontext()), ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+    return list(executor.map(convert, _listdir(dir_path, pattern)))
+
+
+def batch_gsh2pd(dir_path=None, gsheet_ids=None, out_dir='.', read_kwargs={}, write_kwargs={}, workers=4, api_workers=2):
+  # Download the `.gsheet` files in `dir_path` and/or the sheets in `gsheet_ids` (a list, or a dict of ID to output name) as CSV files in `out_dir`.
+  # Sheet reads run with at most `api_workers` concurrent requests and CSV writing on a worker pool. Return one status per sheet.
+  ensure_ready()
+  items = []
+  if dir_path is not None and os.path.exists(dir_path):
+    items.extend((os.path.join(dir_path, fname), None, os.path.splitext(fname)[0]) for fname in _listdir(dir_path, r'.*\.gsheet$'))
+    # Resolve the source folder once for the whole batch
+    if items: RESOLVER.folder_id(fix_dir_path(dir_path))
+  if gsheet_ids:
+    items.extend((None, gsheet_id, name) for gsheet_id, name in (gsheet_ids.items() if isinstance(gsheet_ids, dict) else ((i, i) for i in gsheet_ids)))
+  os.makedirs(out_dir, exist_ok=True)
+  api_slots = threading.BoundedSemaphore(max(1, api_workers))
+  def convert(item):
+    fpath, gsheet_id, name = item
+    status = dict(fpath=fpath, gsheet_id=gsheet_id, csv_fpath=os.path.join(out_dir, '%s.csv' % name), ok=False)
+    try:
+      with api_slots:
+        dataframe = read_gsheet(fpath=fpath, gsheet_id=gsheet_id, **read_kwargs)
+      if dataframe is None: raise IOError('Sheet not found')
+      dataframe.to_csv(status['csv_fpath'], **write_kwargs)
+      status['ok'] = True
+    except Exception as e:
+      warn('Failed to convert [%s]: %s' % (fpath or gsheet_id, e))
+      status['error'] = str(e)
+    return status
+  from concurrent.futures import ThreadPoolExecutor
+  gmeta = read_kwargs.get('gmeta')
+  with (gmeta.batch() if gmeta is not None else contextlib.nullcontext()), ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+    return list(executor.map(convert, items))
 
 
 def main():
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+###########################################################################
+# Copyright (C) 2013-2022 by Caspar. All rights reserved.
+# File Name: manifest.py
+# Author: Shankai Yan
+# E-mail: dr.skyan@gmail.com
+# Created Time: 2022-02-15 09:42:10
+###########################################################################
+#
+
+import os, time, sqlite3, hashlib, threading
+
+
+MANIFEST_DIRNAME = '.cloudshell'
+MANIFEST_FNAME = 'manifest.db'
+MANIFEST_FIELDS = ['relpath', 'size', 'mtime', 'hash', 'synced_at', 'atime', 'hits']
+MANIFEST_COLUMNS = dict(relpath='TEXT PRIMARY KEY', size='INTEGER', mtime='REAL', hash='TEXT', synced_at='REAL', atime='REAL', hits='INTEGER DEFAULT 0')
+
+
+def hash_file(fpath, algo='md5', chunk_size=1<<20):
+    hasher = hashlib.new(algo)
+    with open(fpath, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class SyncManifest(object):
+    # Records the state of each relative path at its last sync: local size, mtime, content hash and when the remote was last checked,
+    # plus the last access time and access count used for cache eviction
+    def __init__(self, db_fpath):
+        self.db_fpath = db_fpath
+        os.makedirs(os.path.dirname(os.path.abspath(db_fpath)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_fpath, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files (%s)' % ', '.join('%s %s' % (k, MANIFEST_COLUMNS[k]) for k in MANIFEST_FIELDS))
+        # Upgrade manifests written by older versions
+        columns = set(row[1] for row in self._conn.execute('PRAGMA table_info(files)'))
+        for k in MANIFEST_FIELDS:
+            if k not in columns: self._conn.execute('ALTER TABLE files ADD COLUMN %s %s' % (k, MANIFEST_COLUMNS[k]))
+
+    def get(self, relpath):
+        with self._lock:
+            row = self._conn.execute('SELECT %s FROM files WHERE relpath = ?' % ', '.join(MANIFEST_FIELDS), (relpath,)).fetchone()
+        return None if row is None else dict(zip(MANIFEST_FIELDS, row))
+
+    def put(self, relpath, size, mtime, hash=None, synced_at=None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT INTO files (relpath, size, mtime, hash, synced_at, atime) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(relpath) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, hash = excluded.hash, synced_at = excluded.synced_at, atime = excluded.atime', (relpath, size, mtime, hash, now if synced_at is None else synced_at, now))
+
+    def access(self, relpath, atime=None):
+        with self._lock:
+            self._conn.execute('UPDATE files SET atime = ?, hits = hits + 1 WHERE relpath = ?', (time.time() if atime is None else atime, relpath))
+
+    def touch(self, relpath, synced_at=None):
+        with self._lock:
+            self._conn.execute('UPDATE files SET synced_at = ? WHERE relpath = ?', (time.time() if synced_at is None else synced_at, relpath))
+
+    def delete(self, relpath):
+        with self._lock:
+            self._conn.execute('DELETE FROM files WHERE relpath = ?', (relpath,))
+
+    def total_size(self):
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+
+    def eviction_order(self, policy='lru'):
+        # Least recently used first, or least frequently used first (ties broken by recency)
+        order = 'atime' if policy == 'lru' else 'hits, atime'
+        with self._lock:
+            rows = self._conn.execute('SELECT %s FROM files ORDER BY %s' % (', '.join(MANIFEST_FIELDS), order)).fetchall()
+        return [dict(zip(MANIFEST_FIELDS, row)) for row in rows]
+
+    def items(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT %s FROM files' % ', '.join(MANIFEST_FIELDS)).fetchall()
+        return [dict(zip(MANIFEST_FIELDS, row)) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
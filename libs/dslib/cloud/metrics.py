@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+###########################################################################
+# Copyright (C) 2013-2022 by Caspar. All rights reserved.
+# File Name: metrics.py
+# Author: Shankai Yan
+# E-mail: dr.skyan@gmail.com
+# Created Time: 2022-02-28 09:42:10
+###########################################################################
+#
+
+import re, json, time, bisect, logging, functools, threading, contextvars
+
+
+# Upper bounds (seconds) of the duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SPAN_COUNTS = ('bytes', 'cells', 'cache_hits', 'cache_misses', 'remote_calls')
+METRIC_PREFIX = 'dslib_'
+
+_ENABLED = False
+_LOGGER = None
+_HOOKS = []
+_CURRENT = contextvars.ContextVar('dslib_cloud_span', default=None)
+
+
+def log(msg, level=logging.INFO):
+    # The output of the cloud modules: printed by default, sent to a logger after `use_logging`
+    if _LOGGER is None:
+        print(msg)
+    else:
+        _LOGGER.log(level, msg)
+
+
+def warn(msg):
+    log(msg, level=logging.WARNING)
+
+
+def use_logging(logger='dslib.cloud'):
+    # Route `log` to a logger (or its name) instead of stdout, None restores the prints
+    global _LOGGER
+    _LOGGER = logging.getLogger(logger) if isinstance(logger, str) else logger
+
+
+class Registry(object):
+    # Counters and duration histograms keyed by (name, sorted labels)
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None: hist = self.histograms[key] = dict(buckets=[0] * len(self.buckets), count=0, sum=0.0)
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets): hist['buckets'][idx] += 1
+            hist['count'] += 1
+            hist['sum'] += value
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_dict(self):
+        # {'counters': [{name, labels, value}], 'histograms': [{name, labels, count, sum, buckets: {le: cumulative count}}]}
+        with self._lock:
+            counters = [dict(name=k[0], labels=dict(k[1]), value=v) for k, v in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), hist in sorted(self.histograms.items()):
+                cumulative, total = {}, 0
+                for le, n in zip(self.buckets, hist['buckets']):
+                    total += n
+                    cumulative[str(le)] = total
+                cumulative['+Inf'] = hist['count']
+                histograms.append(dict(name=name, labels=dict(labels), count=hist['count'], sum=hist['sum'], buckets=cumulative))
+        return dict(counters=counters, histograms=histograms)
+
+    def to_prometheus(self):
+        # Text exposition format
+        def metric_name(name):
+            return METRIC_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        def label_str(labels, **extra):
+            items = list(labels.items()) + list(extra.items())
+            if not items: return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items)
+        data, lines, typed = self.to_dict(), [], set()
+        for item in data['counters']:
+            name = metric_name(item['name'])
+            if name not in typed:
+                lines.append('# TYPE %s counter' % name)
+                typed.add(name)
+            lines.append('%s%s %s' % (name, label_str(item['labels']), item['value']))
+        for item in data['histograms']:
+            name = metric_name(item['name'])
+            if name not in typed:
+                lines.append('# TYPE %s histogram' % name)
+                typed.add(name)
+            for le, n in item['buckets'].items(): lines.append('%s_bucket%s %i' % (name, label_str(item['labels'], le=le), n))
+            lines.append('%s_sum%s %s' % (name, label_str(item['labels']), item['sum']))
+            lines.append('%s_count%s %i' % (name, label_str(item['labels']), item['count']))
+        return '\n'.join(lines) + '\n'
+
+    def to_jsonl(self):
+        # One JSON object per counter or histogram
+        data, timestamp = self.to_dict(), time.time()
+        return ''.join(json.dumps(dict(item, type=kind, timestamp=timestamp), sort_keys=True) + '\n' for kind in ['counters', 'histograms'] for item in data[kind])
+
+
+REGISTRY = Registry()
+
+
+class Span(object):
+    # Times one operation and collects its counts (`SPAN_COUNTS` or any other key). On exit the record is added to the
+    # registry as `<name>_total`, `<name>_<count>_total` and the `<name>_seconds` histogram, then passed to the hooks.
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.counts = {}
+        self.error = None
+        self.start_time = self.seconds = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for k, v in counts.items(): self.counts[k] = self.counts.get(k, 0) + v
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self._token = _CURRENT.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.time() - self.start_time
+        _CURRENT.reset(self._token)
+        if exc_type is not None: self.error = exc_type.__name__
+        labels = dict(self.labels, status='error' if self.error else 'ok')
+        REGISTRY.inc('%s_total' % self.name, **labels)
+        for k, v in self.counts.items(): REGISTRY.inc('%s_%s_total' % (self.name, k), v, **self.labels)
+        REGISTRY.observe('%s_seconds' % self.name, self.seconds, **self.labels)
+        record = self.to_dict()
+        for hook in list(_HOOKS):
+            try:
+                hook(record)
+            except Exception as e:
+                warn('Metrics hook %r failed: %s' % (hook, e))
+        return False
+
+    def to_dict(self):
+        return dict(name=self.name, labels=self.labels, start=self.start_time, seconds=self.seconds, error=self.error, **self.counts)
+
+
+class _NullSpan(object):
+    # Stands in for `Span` while instrumentation is disabled
+    def add(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+def enable(hooks=[]):
+    global _ENABLED
+    _HOOKS.extend(h for h in hooks if h not in _HOOKS)
+    _ENABLED = True
+
+
+def disable():
+    global _ENABLED
+    _ENABLED = False
+
+
+def enabled():
+    return _ENABLED
+
+
+def add_hook(hook):
+    # `hook(record)` is called with the dict of every finished span
+    if hook not in _HOOKS: _HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    if hook in _HOOKS: _HOOKS.remove(hook)
+
+
+def span(name, **labels):
+    return Span(name, **labels) if _ENABLED else NULL_SPAN
+
+
+def count(**counts):
+    # Add counts to the innermost active span, if any
+    if not _ENABLED: return
+    current = _CURRENT.get()
+    if current is not None: current.add(**counts)
+
+
+def instrument(name, **labels):
+    # Decorator running the function in a span
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED: return func(*args, **kwargs)
+            with Span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(func):
+    # Make `func` report to the current span when it runs on another thread (e.g. an executor)
+    current = _CURRENT.get() if _ENABLED else None
+    if current is None: return func
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _CURRENT.set(current)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _CURRENT.reset(token)
+    return wrapper
+
+
+class JsonLinesSink(object):
+    # Hook appending every span record to a JSON lines file
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True, default=str) + '\n'
+        with self._lock, open(self.fpath, 'a') as fd:
+            fd.write(line)
+
+
+def log_hook(record, level=logging.DEBUG):
+    # Hook logging every span record through `log`
+    log('%s %.3fs %s' % (record['name'], record['seconds'], ' '.join('%s=%s' % (k, record[k]) for k in sorted(record) if k not in ('name', 'seconds', 'start', 'labels') and record[k] is not None)), level=level)
+
+
+def to_dict():
+    return REGISTRY.to_dict()
+
+
+def to_prometheus():
+    return REGISTRY.to_prometheus()
+
+
+def to_jsonl():
+    return REGISTRY.to_jsonl()
+
+
+def reset():
+    REGISTRY.reset()
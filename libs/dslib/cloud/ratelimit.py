@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+###########################################################################
+# Copyright (C) 2013-2022 by Caspar. All rights reserved.
+# File Name: ratelimit.py
+# Author: Shankai Yan
+# E-mail: dr.skyan@gmail.com
+# Created Time: 2022-02-23 09:18:44
+###########################################################################
+#
+
+import time, random, socket, threading
+
+from .metrics import warn, count
+
+
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+PRIMITIVE_TYPES = (str, bytes, int, float, bool, list, tuple, dict, set, frozenset, type(None))
+# Attributes of the gspread and pydrive objects that make a request, everything else (e.g. `row_count`, `title`, `id`
+# or the local `ListFile` constructor) is read from the cached metadata without a token
+REMOTE_ATTRS = frozenset([
+    # gspread.Client
+    'open', 'open_by_key', 'open_by_url', 'openall', 'create', 'copy', 'del_spreadsheet', 'list_spreadsheet_files', 'import_csv',
+    # gspread.Spreadsheet
+    'sheet1', 'get_worksheet', 'get_worksheet_by_id', 'worksheet', 'worksheets', 'add_worksheet', 'duplicate_sheet', 'del_worksheet',
+    'fetch_sheet_metadata', 'values_get', 'values_update', 'values_append', 'values_clear', 'values_batch_get', 'values_batch_update',
+    'share', 'list_permissions', 'remove_permissions',
+    # gspread.Worksheet (and Spreadsheet.batch_update)
+    'get', 'batch_get', 'get_all_values', 'get_all_records', 'get_values', 'row_values', 'col_values', 'cell', 'acell', 'range', 'find',
+    'findall', 'update', 'batch_update', 'update_cell', 'update_acell', 'update_cells', 'update_title', 'append_row', 'append_rows',
+    'insert_row', 'insert_rows', 'delete_rows', 'delete_columns', 'add_rows', 'add_cols', 'resize', 'clear', 'batch_clear', 'format',
+    'batch_format', 'freeze', 'sort',
+    # pydrive.files.GoogleDriveFileList and GoogleDriveFile
+    'GetList', 'Upload', 'FetchMetadata', 'FetchContent', 'GetContentFile', 'GetContentString', 'Trash', 'UnTrash', 'Delete',
+    'InsertPermission', 'GetPermissions', 'DeletePermission',
+])
+# Requests that are not safe to repeat when the server may have applied them before failing (a 5xx or a timeout
+# could leave a second spreadsheet or duplicated rows), they are only retried on 429
+NON_IDEMPOTENT_ATTRS = frozenset([
+    'create', 'copy', 'import_csv', 'add_worksheet', 'duplicate_sheet', 'values_append', 'append_row', 'append_rows', 'insert_row',
+    'insert_rows', 'delete_rows', 'delete_columns', 'add_rows', 'add_cols', 'share', 'Upload', 'InsertPermission',
+])
+
+
+class TokenBucket(object):
+    # Allows `rate` calls per second on average with bursts of up to `capacity` calls
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # Take the tokens, sleeping as long as needed, and return the seconds waited
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def error_status(error):
+    # HTTP status of a gspread (`response.status_code`), googleapiclient (`resp.status`) or pydrive (wrapped HttpError) error
+    for err in [error] + [a for a in getattr(error, 'args', ()) if isinstance(a, Exception)]:
+        response = getattr(err, 'response', None)
+        status = getattr(response, 'status_code', None) or getattr(getattr(err, 'resp', None), 'status', None)
+        if status is not None:
+            try:
+                return int(status)
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+def is_retryable(error):
+    return error_status(error) in RETRY_STATUS or isinstance(error, (ConnectionError, TimeoutError, socket.timeout))
+
+
+def is_rate_limited(error):
+    # The request was rejected before it was applied
+    return error_status(error) == 429
+
+
+class ClientStats(object):
+    def __init__(self):
+        self.counts = dict(calls=0, throttled=0, throttled_seconds=0.0, retried=0, failed=0)
+        self._lock = threading.Lock()
+
+    def add(self, key, value=1):
+        with self._lock:
+            self.counts[key] += value
+
+    def to_dict(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+class RateLimitedClient(object):
+    # Proxy that sends the API-backed attributes (`remote`) of the wrapped client through the token bucket, retrying
+    # rate-limit and transient errors with exponential backoff and full jitter (only rate limits for `NON_IDEMPOTENT_ATTRS`).
+    # Returned objects are wrapped too.
+    def __init__(self, client, bucket, retries=5, backoff=1.0, max_backoff=64.0, stats=None, remote=REMOTE_ATTRS):
+        self.__dict__.update(_client=client, _bucket=bucket, _retries=retries, _backoff=backoff, _max_backoff=max_backoff, _stats=stats or ClientStats(), _remote=remote)
+
+    def _wrap(self, value):
+        if isinstance(value, PRIMITIVE_TYPES) or isinstance(value, RateLimitedClient): return value
+        return RateLimitedClient(value, self._bucket, retries=self._retries, backoff=self._backoff, max_backoff=self._max_backoff, stats=self._stats, remote=self._remote)
+
+    def _call(self, retryable, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            waited = self._bucket.acquire()
+            if waited > 0:
+                self._stats.add('throttled')
+                self._stats.add('throttled_seconds', waited)
+            self._stats.add('calls')
+            count(remote_calls=1)
+            try:
+                return self._wrap(func(*args, **kwargs))
+            except Exception as e:
+                if not retryable(e) or attempt >= self._retries:
+                    self._stats.add('failed')
+                    raise
+                delay = random.uniform(0, min(self._max_backoff, self._backoff * 2 ** attempt))
+                warn('Retrying after %s (%.1fs, attempt %i/%i)' % (error_status(e) or type(e).__name__, delay, attempt + 1, self._retries))
+                self._stats.add('retried')
+                count(retries=1)
+                attempt += 1
+                time.sleep(delay)
+
+    def __getattr__(self, name):
+        if name not in self._remote:
+            value = getattr(self._client, name)
+            if callable(value) and not isinstance(value, type):
+                return lambda *args, **kwargs: self._wrap(value(*args, **kwargs))
+            return self._wrap(value)
+        if isinstance(getattr(type(self._client), name, None), property):
+            return self._call(is_retryable, getattr, self._client, name)
+        value = getattr(self._client, name)
+        retryable = is_rate_limited if name in NON_IDEMPOTENT_ATTRS else is_retryable
+        return lambda *args, **kwargs: self._call(retryable, value, *args, **kwargs)
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)
+
+    def __iter__(self):
+        return (self._wrap(v) for v in self._client)
+
+    def __getitem__(self, key):
+        return self._wrap(self._client[key])
+
+    def __len__(self):
+        return len(self._client)
+
+    def __eq__(self, other):
+        return self._client == (other._client if isinstance(other, RateLimitedClient) else other)
+
+    def __hash__(self):
+        return hash(self._client)
+
+    def __repr__(self):
+        return '<RateLimited %r>' % (self._client,)
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+###########################################################################
+# Copyright (C) 2013-2022 by Caspar. All rights reserved.
+# File Name: rclone.py
+# Author: Shankai Yan
+# E-mail: dr.skyan@gmail.com
+# Created Time: 2022-02-16 14:27:03
+###########################################################################
+#
+
+import os, re, time, codecs, random, shutil, tempfile, threading, subprocess
+
+from .supervisor import Daemon, mount_probe, unmount
+from .metrics import log, warn
+
+
+PROMPT_TIMEOUT = 60
+MAX_BUFFER = 1 << 20
+MAX_LINES = 1000
+
+# `rclone mount` settings per workload: `streaming` for sequential scans of large files (e.g. Parquet), `small-files` for
+# random reads of many small files that are worth keeping on disk, and `full-cache` for large files read repeatedly
+MOUNT_PROFILES = {
+    'default': dict(vfs_cache_mode='writes', buffer_size='16M', vfs_read_chunk_size='128M', vfs_read_ahead='0', vfs_cache_max_size='off'),
+    'streaming': dict(vfs_cache_mode='writes', buffer_size='64M', vfs_read_chunk_size='64M', vfs_read_chunk_size_limit='off', vfs_read_ahead='0', vfs_cache_max_size='10G'),
+    'small-files': dict(vfs_cache_mode='full', buffer_size='1M', vfs_read_chunk_size='1M', vfs_read_ahead='0', vfs_cache_max_size='20G', vfs_cache_max_age='24h', dir_cache_time='1h'),
+    'full-cache': dict(vfs_cache_mode='full', buffer_size='32M', vfs_read_chunk_size='32M', vfs_read_ahead='512M', vfs_cache_max_size='50G', vfs_cache_max_age='72h'),
+}
+
+
+def remote_join(remote_root, *paths):
+    # Join paths onto an rclone remote such as `onedrive:`, `onedrive:notebooks` or `:local:/tmp`
+    path = '/'.join(p.replace(os.sep, '/').strip('/') for p in paths if p and p != '.')
+    if not path: return remote_root
+    return remote_root + path if remote_root.endswith((':', '/')) else '%s/%s' % (remote_root, path)
+
+
+class RcloneTransfer(object):
+    # Drives rclone directly so that bulk copies use its parallel transfer pipeline instead of the FUSE mount
+    def __init__(self, remote_root, transfers=8, checkers=16, rclone='rclone', extra_args=[], timeout=None, verbose=False):
+        self.remote_root = remote_root
+        self.transfers = transfers
+        self.checkers = checkers
+        self.rclone = rclone
+        self.extra_args = list(extra_args)
+        self.timeout = timeout
+        self.verbose = verbose
+
+    def available(self):
+        return shutil.which(self.rclone) is not None
+
+    def _run(self, args, **kwargs):
+        cmd = [self.rclone] + args + self.extra_args
+        if self.verbose: log(' '.join(cmd))
+        try:
+            return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout, **kwargs)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            warn('Failed to run rclone: %s' % e)
+            return None
+
+    def copy(self, relative_fpaths, local_root, direction='pull'):
+        # Copy the listed paths between `local_root` and the remote root with a single `rclone copy --files-from`
+        relative_fpaths = list(relative_fpaths)
+        if not relative_fpaths: return True
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', prefix='rclone-files-', delete=False) as fd:
+            fd.write('\n'.join(p.replace(os.sep, '/') for p in relative_fpaths) + '\n')
+            files_from = fd.name
+        try:
+            src, tgt = (self.remote_root, local_root) if direction == 'pull' else (local_root, self.remote_root)
+            proc = self._run(['copy', src, tgt, '--files-from', files_from, '--no-traverse', '--transfers', str(self.transfers), '--checkers', str(self.checkers)])
+        finally:
+            os.remove(files_from)
+        if proc is None: return False
+        if proc.returncode != 0:
+            warn('rclone copy exited with code %i: %s' % (proc.returncode, proc.stderr.decode('utf-8', 'replace').strip()))
+            return False
+        return True
+
+    def cat(self, relative_fpath, offset=0, count=-1):
+        # Read a byte range of a remote file without copying the whole file
+        args = ['cat', remote_join(self.remote_root, relative_fpath), '--offset', str(offset)]
+        if count >= 0: args += ['--count', str(count)]
+        proc = self._run(args)
+        if proc is None or proc.returncode != 0: return None
+        return proc.stdout
+
+
+class InteractiveCMD(object):
+    # Runs a command with piped stdin and the stdout/stderr read into one buffer in raw chunks, so that prompts without
+    # a trailing newline can be matched by `expect` as soon as they are printed.
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.p = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=isinstance(cmd, str))
+        self._chunks = []
+        self._pos = 0
+        self._printed = 0
+        self._eof = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self, verbose=False):
+        self._thread = threading.Thread(target=self._read_output, daemon=True)
+        self._thread.start()
+
+    def _read_output(self):
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        fd = self.p.stdout.fileno()
+        while True:
+            data = os.read(fd, 4096)
+            text = decoder.decode(data, final=not data)
+            with self._cond:
+                if text: self._chunks.append(text)
+                if not data: self._eof = True
+                self._cond.notify_all()
+            if not data: break
+        self.p.stdout.close()
+
+    def _output(self):
+        # Join the chunks read so far into one string, called with the condition held
+        if len(self._chunks) > 1: self._chunks[:] = [''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else ''
+
+    def input(self, input_str, verbose=False):
+        if verbose: log('Your input: %s' % input_str)
+        self.p.stdin.write((input_str.strip('\n') + '\n').encode('utf-8'))
+        self.p.stdin.flush()
+        if verbose: self.print_output_error()
+
+    def inputs(self, inputs, intervel=0, verbose=False):
+        for input_str in inputs:
+            self.input(input_str, verbose=verbose)
+            time.sleep(intervel)
+
+    def expect(self, patterns, timeout=PROMPT_TIMEOUT):
+        # Wait until the output after the last match matches one of the patterns. Return (index, match), or (None, None) at EOF.
+        patterns = [re.compile(p) if isinstance(p, str) else p for p in (patterns if isinstance(patterns, (list, tuple)) else [patterns])]
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                output = self._output()
+                for i, pattern in enumerate(patterns):
+                    m = pattern.search(output, self._pos)
+                    if m is not None:
+                        self._pos = m.end()
+                        return i, m
+                if self._eof: return None, None
+                remaining = deadline - time.time()
+                if remaining <= 0: raise TimeoutError('No prompt matching %s within %ss, last output: %r' % ([p.pattern for p in patterns], timeout, output[self._pos:][-200:]))
+                self._cond.wait(remaining)
+
+    def interact(self, rules, timeout=PROMPT_TIMEOUT, verbose=False):
+        # Answer prompts until the command exits. `rules` is a list of (pattern, answer) where the answer is a string
+        # or a callable on the match; the pattern is searched in the output printed since the previous answer.
+        answered = []
+        while True:
+            idx, m = self.expect([pattern for pattern, answer in rules], timeout=timeout)
+            if idx is None: break
+            answer = rules[idx][1]
+            answer = answer(m) if callable(answer) else answer
+            answered.append(answer)
+            self.input(answer, verbose=verbose)
+        return answered
+
+    def wait(self, timeout=None):
+        returncode = self.p.wait(timeout=timeout)
+        if self._thread is not None: self._thread.join(timeout)
+        return returncode
+
+    def print_output_error(self):
+        with self._cond:
+            output = self._output()
+            log(output[self._printed:])
+            self._printed = len(output)
+
+
+class AsyncInteractiveCMD(object):
+    # asyncio counterpart of `InteractiveCMD` for driving many rclone/webdav processes from one event loop. The merged
+    # stdout/stderr is read by a task rather than a thread; the text buffer keeps at most `max_buffer` characters and
+    # complete lines are also queued for `lines()`, dropping the oldest beyond `max_lines`.
+    def __init__(self, *args, max_buffer=MAX_BUFFER, max_lines=MAX_LINES):
+        self.args = args
+        self.max_buffer = max_buffer
+        self.max_lines = max_lines
+        self.p = None
+        self.dropped_lines = 0
+        self._chunks, self._size = [], 0
+        self._base, self._pos = 0, 0
+        self._partial = ''
+        self._eof = False
+        self._changed = self._lines = self._reader = None
+
+    async def start(self):
+        import asyncio
+        self._changed, self._lines = asyncio.Event(), asyncio.Queue()
+        self.p = await asyncio.create_subprocess_exec(*self.args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        self._reader = asyncio.ensure_future(self._read_output())
+        return self
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _push_line(self, line):
+        if self._lines.qsize() >= self.max_lines:
+            self._lines.get_nowait()
+            self.dropped_lines += 1
+        self._lines.put_nowait(line)
+
+    async def _read_output(self):
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            data = await self.p.stdout.read(4096)
+            text = decoder.decode(data, final=not data)
+            if text:
+                self._chunks.append(text)
+                self._size += len(text)
+                if self._size > self.max_buffer: self._trim()
+                lines = (self._partial + text).split('\n')
+                self._partial = lines.pop()
+                for line in lines: self._push_line(line + '\n')
+            if not data:
+                if self._partial: self._push_line(self._partial)
+                self._partial, self._eof = '', True
+                self._lines.put_nowait(None)
+            self._changed.set()
+            if not data: break
+
+    def _trim(self):
+        # Keep the tail of the output, positions are absolute so matches already consumed stay consumed
+        output = ''.join(self._chunks)[-self.max_buffer:]
+        self._base += self._size - len(output)
+        self._chunks, self._size = [output], len(output)
+
+    def _output(self):
+        if len(self._chunks) > 1: self._chunks[:] = [''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else ''
+
+    async def lines(self):
+        # Stream the output line by line until EOF
+        while True:
+            line = await self._lines.get()
+            if line is None:
+                self._lines.put_nowait(None)
+                return
+            yield line
+
+    async def input(self, input_str, verbose=False):
+        if verbose: log('Your input: %s' % input_str)
+        self.p.stdin.write((input_str.strip('\n') + '\n').encode('utf-8'))
+        await self.p.stdin.drain()
+
+    async def expect(self, patterns, timeout=PROMPT_TIMEOUT):
+        # Same contract as `InteractiveCMD.expect`
+        import asyncio
+        patterns = [re.compile(p) if isinstance(p, str) else p for p in (patterns if isinstance(patterns, (list, tuple)) else [patterns])]
+        deadline = time.time() + timeout
+        while True:
+            self._changed.clear()
+            output = self._output()
+            start = max(0, self._pos - self._base)
+            for i, pattern in enumerate(patterns):
+                m = pattern.search(output, start)
+                if m is not None:
+                    self._pos = self._base + m.end()
+                    return i, m
+            if self._eof: return None, None
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(0, deadline - time.time()))
+            except asyncio.TimeoutError:
+                raise TimeoutError('No prompt matching %s within %ss, last output: %r' % ([p.pattern for p in patterns], timeout, output[start:][-200:]))
+
+    async def interact(self, rules, timeout=PROMPT_TIMEOUT, verbose=False):
+        # Same contract as `InteractiveCMD.interact`
+        answered = []
+        while True:
+            idx, m = await self.expect([pattern for pattern, answer in rules], timeout=timeout)
+            if idx is None: break
+            answer = rules[idx][1]
+            answer = answer(m) if callable(answer) else answer
+            answered.append(answer)
+            await self.input(answer, verbose=verbose)
+        return answered
+
+    async def wait(self, timeout=None):
+        import asyncio
+        returncode = await asyncio.wait_for(self.p.wait(), timeout)
+        await self._reader
+        return returncode
+
+    async def close(self, timeout=5):
+        if self.p is None: return
+        if self.p.returncode is None:
+            self.p.kill()
+        await self.wait(timeout)
+
+
+def list_remotes(rclone='rclone'):
+    proc = subprocess.run([rclone, 'listremotes'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return [l.strip().rstrip(':') for l in proc.stdout.decode('utf-8').splitlines() if l.strip()] if proc.returncode == 0 else []
+
+
+def config_create(name, storage, params={}, obscure=True, rclone='rclone', timeout=PROMPT_TIMEOUT, verbose=False):
+    # Create a remote in one non-interactive call, passwords in `params` are obscured by rclone with `obscure`
+    cmd = [rclone, 'config', 'create', name, storage] + ['%s=%s' % kv for kv in params.items()] + ['--non-interactive'] + (['--obscure'] if obscure else [])
+    if verbose: log(' '.join(cmd[:5]) + ' ...')
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    if proc.returncode != 0:
+        raise RuntimeError('rclone config create exited with code %i: %s' % (proc.returncode, proc.stderr.decode('utf-8', 'replace').strip()))
+    return True
+
+
+def config_interactive(name, storage, rules, rclone='rclone', timeout=PROMPT_TIMEOUT, verbose=False):
+    # Walk the `rclone config` dialog for backends that need it (e.g. OAuth drive selection). The storage type is
+    # answered by name instead of its menu number, `rules` answers the backend questions and any other y/n question
+    # takes its default.
+    created = []
+    def main_menu(m):
+        if created: return 'q'
+        created.append(True)
+        return 'n'
+    rules = [(r'[a-z/]*/q> $', main_menu), (r'(?m)^name> $', name), (r'(?m)^Storage> $', storage)] + list(rules) + [
+        (r'y/e/d> $', 'y'), (r'y/n> $', '')]
+    cmd = InteractiveCMD([rclone, 'config'])
+    cmd.start()
+    try:
+        answered = cmd.interact(rules, timeout=timeout, verbose=verbose)
+    finally:
+        if cmd.p.poll() is None: cmd.p.kill()
+        cmd.wait(timeout)
+    if name not in list_remotes(rclone):
+        raise RuntimeError('Failed to configure remote [%s] after %i answers' % (name, len(answered)))
+    return True
+
+
+def profile_args(profile='default', **overrides):
+    # Command line flags of a mount profile, an override of None drops the flag
+    if profile not in MOUNT_PROFILES: raise ValueError('Unknown mount profile [%s], choose from %s' % (profile, sorted(MOUNT_PROFILES)))
+    settings = dict(MOUNT_PROFILES[profile], **overrides)
+    return [arg for k, v in settings.items() if v is not None for arg in ('--%s' % k.replace('_', '-'), str(v))]
+
+
+def mount_daemon(remote, mountpoint, log_fpath=os.devnull, args=profile_args(), rclone='rclone', name=None):
+    # An `rclone mount` kept in the foreground so that its PID can be supervised, ready once the mountpoint is serving
+    cmd = [rclone, 'mount', '--allow-non-empty'] + list(args) + [remote, mountpoint]
+    return Daemon(name or 'rclone mount %s' % mountpoint, cmd, mount_probe(mountpoint), log_fpath=log_fpath, before_start=lambda: unmount(mountpoint))
+
+
+def _read_workload(root, fpaths, workload='sequential', read_size=1 << 20, samples=64, seed=0):
+    # Read the files whole in `read_size` pieces, or `samples` random `read_size` ranges of each. Return the bytes read.
+    rand = random.Random(seed)
+    nbytes = 0
+    for fpath in fpaths:
+        with open(os.path.join(root, fpath), 'rb', buffering=0) as fd:
+            if workload == 'sequential':
+                while True:
+                    data = fd.read(read_size)
+                    if not data: break
+                    nbytes += len(data)
+            else:
+                size = os.fstat(fd.fileno()).st_size
+                for i in range(samples):
+                    fd.seek(rand.randrange(max(1, size - read_size + 1)))
+                    nbytes += len(fd.read(read_size))
+    return nbytes
+
+
+def _sample_files(root, rel_dir='', max_files=20):
+    fpaths = []
+    for dir_path, dirs, fnames in os.walk(os.path.join(root, rel_dir)):
+        dirs.sort()
+        fpaths.extend(os.path.relpath(os.path.join(dir_path, f), root) for f in sorted(fnames))
+        if len(fpaths) >= max_files: break
+    return fpaths[:max_files]
+
+
+def autotune(remote, rel_dir='', fpaths=None, profiles=None, workload='sequential', read_size=None, passes=2, max_files=20, rclone='rclone', timeout=60, verbose=False):
+    # Mount the remote once per candidate profile (each with its own cache directory), time `passes` reads of the sample
+    # files and return (fastest profile, results). `workload` is 'sequential' for whole-file scans or 'random' for
+    # random `read_size` ranges; a second pass shows what each profile gains from its cache.
+    read_size = read_size or (1 << 20 if workload == 'sequential' else 64 << 10)
+    results = {}
+    for profile in (profiles or [p for p in MOUNT_PROFILES]):
+        work_dir = tempfile.mkdtemp(prefix='rclone-autotune-')
+        mountpoint = os.path.join(work_dir, 'mnt')
+        os.makedirs(mountpoint)
+        daemon = mount_daemon(remote, mountpoint, log_fpath=os.path.join(work_dir, 'rclone.log'), args=profile_args(profile) + ['--cache-dir', os.path.join(work_dir, 'cache')], rclone=rclone, name='autotune-%s' % profile)
+        try:
+            daemon.start().wait_ready(timeout)
+            sample = fpaths or _sample_files(mountpoint, rel_dir, max_files=max_files)
+            if not sample: raise IOError('No files to read in %s' % remote_join(remote, rel_dir))
+            timings, nbytes = [], 0
+            for i in range(passes):
+                start_time = time.time()
+                nbytes = _read_workload(mountpoint, sample, workload=workload, read_size=read_size)
+                timings.append(time.time() - start_time)
+            results[profile] = dict(files=len(sample), bytes=nbytes, seconds=timings, throughput=nbytes * passes / max(sum(timings), 1e-9), ok=True)
+        except Exception as e:
+            warn('Failed to benchmark profile [%s]: %s' % (profile, e))
+            results[profile] = dict(ok=False, error=str(e))
+        finally:
+            daemon.stop()
+            unmount(mountpoint)
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if verbose and results[profile]['ok']: log('%s: %.1f MB/s (%s)' % (profile, results[profile]['throughput'] / 1e6, ', '.join('%.2fs' % t for t in results[profile]['seconds'])))
+    ranked = sorted((r['throughput'], p) for p, r in results.items() if r['ok'])
+    best = ranked[-1][1] if ranked else None
+    if verbose and best: log('Recommended mount profile: %s' % best)
+    return best, results
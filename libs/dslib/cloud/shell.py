@@ -0,0 +1,685 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+###########################################################################
+# Copyright (C) 2013-2022 by Caspar. All rights reserved.
+# File Name: shell.py
+# Author: Shankai Yan
+# E-mail: dr.skyan@gmail.com
+# Created Time: 2022-02-14 11:05:48
+###########################################################################
+#
+
+import os, io, glob, time, queue, shutil, hashlib, fnmatch, itertools, threading, contextlib
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+from .manifest import MANIFEST_DIRNAME, MANIFEST_FNAME, SyncManifest, hash_file
+from .blockio import BLOCK_SIZE, READAHEAD, BlockReader
+from .writeback import WriteBackQueue
+from .metrics import log, warn, span, count
+
+
+def mkdir(path, verbose=False):
+  if path and not os.path.exists(path):
+    if verbose: log(("Creating folder: " + path))
+    os.makedirs(path, exist_ok=True)
+
+
+def fixdir(path, default_reldir='.', verbose=False):
+    try:
+        mkdir(path, verbose=verbose)
+        if not os.access(path, os.W_OK): raise PermissionError('Cannot access `%s` !' % path)
+        return os.path.abspath(path)
+    except Exception as e:
+        if verbose: warn(e)
+        default_dir = os.path.join('.', default_reldir)
+        mkdir(default_dir, verbose=verbose)
+        return os.path.abspath(default_dir)
+
+
+def _match(relative_fpath, include=None, exclude=None):
+    fname = os.path.basename(relative_fpath)
+    matched = lambda patterns: any(fnmatch.fnmatch(relative_fpath, p) or fnmatch.fnmatch(fname, p) for p in patterns)
+    if include and not matched([include] if isinstance(include, str) else include): return False
+    if exclude and matched([exclude] if isinstance(exclude, str) else exclude): return False
+    return True
+
+
+def scan_tree(root, rel_dir='', include=None, exclude=None, scandir=os.scandir):
+    # Walk the directory once with `scandir` and return {relative path to `root`: (size, mtime)}
+    files, stack = {}, [os.path.join(root, rel_dir) if rel_dir else root]
+    while stack:
+        try:
+            entries = scandir(stack.pop())
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != MANIFEST_DIRNAME: stack.append(entry.path)
+                elif entry.is_file():
+                    relative_fpath = os.path.relpath(entry.path, root)
+                    if not _match(os.path.relpath(entry.path, os.path.join(root, rel_dir)) if rel_dir else relative_fpath, include=include, exclude=exclude): continue
+                    stat = entry.stat()
+                    files[relative_fpath] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+class CloudShell(object):
+    def __init__(self, cloud_path_root, local_path_root, workers=4, manifest=True, manifest_ttl=3600, hash_algo='md5', transfer=None, cache_size=None, cache_policy='lru', writeback=False, verbose=False):
+        self.cloud_path_root = os.path.abspath(cloud_path_root)
+        self.local_path_root = os.path.abspath(local_path_root)
+        self.workers = workers
+        # Optional `RcloneTransfer` for bulk pushes/pulls, the mounted path is used when it is missing or fails
+        self.transfer = transfer
+        # The remote is only checked again for manifest entries older than `manifest_ttl` seconds (None: never)
+        self.manifest = SyncManifest(os.path.join(self.local_path_root, MANIFEST_DIRNAME, MANIFEST_FNAME)) if manifest else None
+        self.manifest_ttl = manifest_ttl
+        self.hash_algo = hash_algo
+        # Byte budget of the local copies, clean and unpinned files are evicted by `cache_policy` ('lru' or 'lfu') once it is exceeded
+        self.cache_size = cache_size
+        self.cache_policy = cache_policy
+        self.verbose = verbose
+        self._stats = dict(hits=0, misses=0, evictions=0, evicted_bytes=0)
+        self._stats_lock = threading.Lock()
+        self._pins = {}
+        self._open_blocks = {}
+        self._readahead_pool = None
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._prefetch_queue = None
+        self._prefetchers = []
+        self._prefetch_seq = itertools.count()
+        # With `writeback`, pushes are queued to background uploaders (`writeback` threads) instead of blocking the caller
+        self.writeback = WriteBackQueue(self._upload, workers=int(writeback), verbose=verbose) if writeback else None
+        self._dir_lock = threading.Lock()
+        self._dir_locks = {}
+        self._known_dirs = set()
+
+    def _map(self, fpath):
+        local_fpath = os.path.abspath(fpath)
+        if not local_fpath.startswith(self.local_path_root):
+            warn('The file [%s] is not mapped to cloud location [%s]!' % (fpath, self.cloud_path_root))
+            return None
+        relative_fpath = os.path.relpath(local_fpath, self.local_path_root)
+        return local_fpath, relative_fpath, os.path.join(self.cloud_path_root, relative_fpath)
+
+    def _makedirs(self, path):
+        # One lock per directory so that concurrent transfers never create the same folder twice
+        if path in self._known_dirs: return
+        with self._dir_lock:
+            lock = self._dir_locks.setdefault(path, threading.Lock())
+        with lock:
+            if path not in self._known_dirs:
+                mkdir(path, verbose=self.verbose)
+                self._known_dirs.add(path)
+
+    def _copy(self, src_fpath, tgt_fpath):
+        # Keep the source mtime so that a pulled file does not look newer than the cloud copy
+        self._makedirs(os.path.dirname(tgt_fpath))
+        shutil.copy2(src_fpath, tgt_fpath)
+
+    # The metadata requests to the cloud side, None if the file does not exist
+    def _cloud_stat(self, cloud_fpath):
+        try:
+            return os.stat(cloud_fpath)
+        except FileNotFoundError:
+            return None
+
+    def _cloud_scandir(self, path):
+        return os.scandir(path)
+
+    def _record(self, relative_fpath, local_fpath):
+        if self.manifest is None: return
+        stat = os.stat(local_fpath)
+        self.manifest.put(relative_fpath, stat.st_size, stat.st_mtime, hash=hash_file(local_fpath, self.hash_algo) if self.hash_algo else None)
+
+    def _is_fresh(self, entry):
+        return self.manifest_ttl is None or time.time() - entry['synced_at'] < self.manifest_ttl
+
+    def _transfer(self, action, relative_fpath):
+        local_fpath, cloud_fpath = os.path.join(self.local_path_root, relative_fpath), os.path.join(self.cloud_path_root, relative_fpath)
+        if action == 'push':
+            self._copy(local_fpath, cloud_fpath)
+        else:
+            # Pull into a temporary file so that a partial copy is never taken for a local file
+            tmp_fpath = '%s.%i.part' % (local_fpath, threading.get_ident())
+            try:
+                self._copy(cloud_fpath, tmp_fpath)
+                os.replace(tmp_fpath, local_fpath)
+            finally:
+                if os.path.exists(tmp_fpath): os.remove(tmp_fpath)
+        self._record(relative_fpath, local_fpath)
+        count(remote_calls=1)
+        return os.path.getsize(local_fpath)
+
+    def _claim(self, relative_fpath, create=True):
+        # Return the future of the pull and whether the caller has to carry it out
+        with self._inflight_lock:
+            task = self._inflight.get(relative_fpath)
+            if task is None:
+                if not create: return None, False
+                task = self._inflight[relative_fpath] = dict(future=Future(), started=False)
+            if task['started']: return task['future'], False
+            task['started'] = True
+            return task['future'], True
+
+    def _pull(self, relative_fpath, create=True, keep_local=False):
+        # Pull once, concurrent callers (prefetch, sync, open) wait on the same transfer. With `keep_local`, a local file
+        # written since the pull was queued is kept and None is returned.
+        future, owner = self._claim(relative_fpath, create=create)
+        if future is None: return None
+        if not owner: return future.result()
+        try:
+            if keep_local and os.path.exists(os.path.join(self.local_path_root, relative_fpath)):
+                future.set_result(0)
+                return None
+            nbytes = self._transfer('pull', relative_fpath)
+            future.set_result(nbytes)
+            return nbytes
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(relative_fpath, None)
+
+    def _wait_inflight(self, relative_fpath, timeout=None):
+        with self._inflight_lock:
+            task = self._inflight.get(relative_fpath)
+        if task is None or not task['started']: return
+        try:
+            task['future'].result(timeout=timeout)
+        except Exception:
+            pass
+
+    def _decide(self, fpath):
+        # Work out whether the file needs a push or a pull, without transferring it
+        start_time = time.time()
+        result = dict(fpath=fpath, relpath=None, action='skip', bytes=0, seconds=0.0, ok=True)
+        try:
+            mapped = self._map(fpath)
+            if mapped is None:
+                result.update(action='error', ok=False, error='unmapped')
+                return result
+            local_fpath, relative_fpath, cloud_fpath = mapped
+            result['relpath'] = relative_fpath
+            self._wait_inflight(relative_fpath)
+            try:
+                local_stat = os.stat(local_fpath)
+            except FileNotFoundError:
+                local_stat = None
+            if local_stat is not None:
+                entry = self.manifest.get(relative_fpath) if self.manifest is not None else None
+                if entry is not None: self.manifest.access(relative_fpath)
+                if entry is not None and (entry['size'], entry['mtime']) == (local_stat.st_size, local_stat.st_mtime):
+                    # Clean since the last sync, only ask the remote once the entry has expired and then only whether it changed
+                    if self._is_fresh(entry):
+                        self._count('hits')
+                        return result
+                    cloud_stat = self._cloud_stat(cloud_fpath)
+                    if cloud_stat is not None and (cloud_stat.st_size != entry['size'] or cloud_stat.st_mtime > entry['synced_at']):
+                        self._count('misses')
+                        result.update(action='pull')
+                        return result
+                    push = cloud_stat is None
+                elif entry is not None:
+                    # Modified locally since the last sync
+                    push = True
+                else:
+                    cloud_stat = self._cloud_stat(cloud_fpath)
+                    push = cloud_stat is None or cloud_stat.st_mtime < local_stat.st_mtime
+                if push:
+                    result.update(action='push', bytes=local_stat.st_size)
+                    return result
+                # The local copy is served as is
+                self._count('hits')
+                if entry is not None:
+                    self.manifest.touch(relative_fpath)
+                else:
+                    self._record(relative_fpath, local_fpath)
+            else:
+                if self._cloud_stat(cloud_fpath) is not None:
+                    self._count('misses')
+                    result.update(action='pull')
+                else:
+                    warn('Cannot find file [%s] on the cloud!' % cloud_fpath)
+                    result.update(action='error', ok=False, error='not found')
+        except Exception as e:
+            warn('Failed to sync file [%s]: %s' % (fpath, e))
+            result.update(action='error', ok=False, error=str(e))
+        finally:
+            result['seconds'] = time.time() - start_time
+        return result
+
+    def _apply(self, result):
+        # Carry out the action of a decided result in place
+        start_time = time.time()
+        try:
+            if result['action'] == 'pull':
+                result['bytes'] = self._pull(result['relpath'])
+            elif result['action'] == 'push':
+                result['bytes'] = self._transfer(result['action'], result['relpath'])
+            elif result['action'] in ('delete_local', 'delete_remote'):
+                os.remove(os.path.join(self.local_path_root if result['action'] == 'delete_local' else self.cloud_path_root, result['relpath']))
+                if self.manifest is not None: self.manifest.delete(result['relpath'])
+        except Exception as e:
+            warn('Failed to %s file [%s]: %s' % (result['action'].replace('_', ' '), result['fpath'], e))
+            result.update(ok=False, error=str(e))
+        finally:
+            result['seconds'] += time.time() - start_time
+        return result
+
+    def _bulk_transfer(self, results, callback=None):
+        # Hand the pushes and pulls to the rclone backend in one call per direction, return the results left for the FUSE path
+        if self.transfer is None or not self.transfer.available(): return results
+        remaining = [r for r in results if r['action'] not in ('push', 'pull')]
+        for action in ['pull', 'push']:
+            batch = [r for r in results if r['action'] == action]
+            if not batch: continue
+            start_time = time.time()
+            if not self.transfer.copy([r['relpath'] for r in batch], self.local_path_root, direction=action):
+                warn('Falling back to the mounted path for %i %s(s).' % (len(batch), action))
+                remaining.extend(batch)
+                continue
+            seconds = (time.time() - start_time) / len(batch)
+            for i, result in enumerate(batch):
+                result['seconds'] += seconds
+                try:
+                    local_fpath = os.path.join(self.local_path_root, result['relpath'])
+                    self._record(result['relpath'], local_fpath)
+                    result['bytes'] = os.path.getsize(local_fpath)
+                except Exception as e:
+                    result.update(ok=False, error=str(e))
+                if callback is not None: callback(i + 1, len(batch), result)
+        return remaining
+
+    def _upload(self, relative_fpath):
+        return self._apply(dict(fpath=os.path.join(self.local_path_root, relative_fpath), relpath=relative_fpath, action='push', bytes=0, seconds=0.0, ok=True))['ok']
+
+    def _enqueue(self, result):
+        self.writeback.put(result['relpath'])
+        result.update(bytes=0, queued=True)
+        return result
+
+    def _execute(self, results, workers=None, callback=None):
+        pending = [r for r in results if r['ok'] and r['action'] != 'skip']
+        if self.writeback is not None:
+            pending = [r for r in pending if r['action'] != 'push' or not self._enqueue(r)]
+        pending = self._bulk_transfer(pending, callback=callback)
+        with ThreadPoolExecutor(max_workers=max(1, self.workers if workers is None else workers)) as executor:
+            futures = [executor.submit(self._apply, result) for result in pending]
+            for i, future in enumerate(as_completed(futures)):
+                result = future.result()
+                if callback is not None: callback(i + 1, len(futures), result)
+                if self.verbose: log('[%i/%i] %s %s' % (i + 1, len(futures), result['action'], result['fpath']))
+        if any(r['action'] == 'pull' for r in results): self.evict()
+        return results
+
+    def _sync(self, fpath):
+        with span('cloudshell.sync') as sp:
+            result = self._decide(fpath)
+            if result['ok'] and result['action'] == 'push' and self.writeback is not None: return self._enqueue(result)
+            if result['ok']: self._apply(result)
+            sp.add(**(dict(bytes=result['bytes']) if result['ok'] else dict(failed=1)))
+            if result['action'] == 'pull': self.evict()
+            return result
+
+    def queue_depth(self):
+        return self.writeback.depth() if self.writeback is not None else 0
+
+    def flush(self, timeout=None):
+        # Barrier for the write-back queue, return False if uploads are still running after `timeout`
+        return self.writeback.flush(timeout=timeout) if self.writeback is not None else True
+
+    wait = flush
+
+    def prefetch(self, paths_or_glob, priority=0):
+        # Start pulling the files in the background, higher `priority` first. Glob patterns are expanded on the cloud side.
+        fpaths = []
+        for fpath in [paths_or_glob] if isinstance(paths_or_glob, str) else paths_or_glob:
+            if not glob.has_magic(fpath):
+                fpaths.append(fpath)
+                continue
+            mapped = self._map(fpath)
+            if mapped is None: continue
+            fpaths.extend(os.path.join(self.local_path_root, os.path.relpath(cloud_fpath, self.cloud_path_root)) for cloud_fpath in glob.glob(mapped[2], recursive=True) if os.path.isfile(cloud_fpath))
+        self._start_prefetchers()
+        queued = []
+        for fpath in fpaths:
+            mapped = self._map(fpath)
+            if mapped is None or os.path.exists(mapped[0]): continue
+            with self._inflight_lock:
+                if mapped[1] in self._inflight: continue
+                self._inflight[mapped[1]] = dict(future=Future(), started=False)
+            self._prefetch_queue.put((-priority, next(self._prefetch_seq), mapped[1]))
+            queued.append(mapped[0])
+        return queued
+
+    def _start_prefetchers(self):
+        with self._inflight_lock:
+            if self._prefetch_queue is not None: return
+            self._prefetch_queue = queue.PriorityQueue()
+        for i in range(max(1, self.workers)):
+            self._prefetchers.append(threading.Thread(target=self._prefetch_work, name='prefetch-%i' % i, daemon=True))
+            self._prefetchers[-1].start()
+
+    def _prefetch_work(self):
+        while True:
+            _, _, relative_fpath = self._prefetch_queue.get()
+            if relative_fpath is None: return
+            try:
+                # Skip the files that a caller has pulled or written in the meantime
+                if self._pull(relative_fpath, create=False, keep_local=True) is None: continue
+                self._count('misses')
+                if self.verbose: log('Prefetched %s' % relative_fpath)
+                self.evict()
+            except Exception as e:
+                warn('Failed to prefetch file [%s]: %s' % (relative_fpath, e))
+
+    def close(self, timeout=None):
+        if self._prefetch_queue is not None:
+            for i in range(max(1, self.workers)): self._prefetch_queue.put((float('inf'), next(self._prefetch_seq), None))
+            # The queued prefetches still record their files in the manifest
+            deadline = None if timeout is None else time.time() + timeout
+            for thread in self._prefetchers: thread.join(None if deadline is None else max(0, deadline - time.time()))
+        if self.writeback is not None: self.writeback.close(timeout=timeout)
+        if self._readahead_pool is not None: self._readahead_pool.shutdown(wait=False)
+        if self.manifest is not None: self.manifest.close()
+
+    def _count(self, key, value=1):
+        with self._stats_lock:
+            self._stats[key] += value
+        count(**{'cache_%s' % key: value})
+
+    def pin(self, fpath):
+        mapped = self._map(fpath)
+        if mapped is None: return False
+        with self._stats_lock:
+            self._pins[mapped[1]] = self._pins.get(mapped[1], 0) + 1
+        return True
+
+    def unpin(self, fpath):
+        mapped = self._map(fpath)
+        if mapped is None: return
+        with self._stats_lock:
+            if self._pins.get(mapped[1], 0) > 1:
+                self._pins[mapped[1]] -= 1
+            else:
+                self._pins.pop(mapped[1], None)
+
+    @contextlib.contextmanager
+    def pinned(self, fpath):
+        # Keep the local copy out of eviction while it is in use
+        self.pin(fpath)
+        try:
+            yield fpath
+        finally:
+            self.unpin(fpath)
+
+    def _derived_caches(self):
+        # Block cache directories and cached frames as (last use, bytes, path), least recently used first
+        root = os.path.join(self.local_path_root, MANIFEST_DIRNAME)
+        caches = []
+        for kind in ['blocks', 'frames']:
+            try:
+                entries = list(os.scandir(os.path.join(root, kind)))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                    size = sum(e.stat().st_size for e in os.scandir(entry.path)) if entry.is_dir() else stat.st_size
+                except FileNotFoundError:
+                    continue
+                caches.append((stat.st_mtime, size, entry.path))
+        return sorted(caches)
+
+    def evict(self, cache_size=None):
+        # Remove derived caches (blocks and frames), then clean local copies in eviction order until everything fits in
+        # the budget, return the bytes freed
+        cache_size = self.cache_size if cache_size is None else cache_size
+        if cache_size is None: return 0
+        caches = self._derived_caches()
+        total_size, freed = (self.manifest.total_size() if self.manifest is not None else 0) + sum(c[1] for c in caches), 0
+        if total_size <= cache_size: return 0
+        with self._stats_lock:
+            open_blocks = set(self._open_blocks)
+        for used, size, path in caches:
+            if total_size <= cache_size: break
+            if path in open_blocks: continue
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                warn('Failed to evict cache [%s]: %s' % (path, e))
+                continue
+            total_size -= size
+            freed += size
+            self._count('evictions')
+            self._count('evicted_bytes', size)
+        if self.manifest is None: return freed
+        for entry in self.manifest.eviction_order(self.cache_policy):
+            if total_size <= cache_size: break
+            if entry['relpath'] in self._pins: continue
+            local_fpath = os.path.join(self.local_path_root, entry['relpath'])
+            try:
+                stat = os.stat(local_fpath)
+                # Only files unchanged since their last push/pull are safe to drop
+                if (stat.st_size, stat.st_mtime) != (entry['size'], entry['mtime']): continue
+                os.remove(local_fpath)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                warn('Failed to evict file [%s]: %s' % (local_fpath, e))
+                continue
+            self.manifest.delete(entry['relpath'])
+            total_size -= entry['size']
+            freed += entry['size']
+            self._count('evictions')
+            self._count('evicted_bytes', entry['size'])
+            if self.verbose: log('Evicted %s' % local_fpath)
+        return freed
+
+    def cache_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update(hit_rate=stats['hits'] / float(stats['hits'] + stats['misses']) if stats['hits'] + stats['misses'] else 0.0, size=self.manifest.total_size() if self.manifest is not None else None, limit=self.cache_size,
+            derived_size=sum(c[1] for c in self._derived_caches()))
+        return stats
+
+    def sync(self, fpath):
+        return self._sync(fpath)['ok']
+
+    def batch_sync(self, fpaths, workers=None, callback=None):
+        # Sync the files on a bounded thread pool (or the rclone backend), return the per-file results in input order and a summary
+        workers = max(1, self.workers if workers is None else workers)
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(self._decide, fpaths))
+        self._execute(results, workers=workers, callback=callback)
+        return results, CloudShell._summarize(results, time.time() - start_time)
+
+    def _plan_tree(self, local_files, cloud_files, direction, delete):
+        # Decide the action of every path from the two listings and the manifest, without touching either tree again
+        plan = dict(pull=[], push=[], delete_local=[], delete_remote=[], skip=[])
+        for relative_fpath in sorted(set(local_files) | set(cloud_files)):
+            local, cloud = local_files.get(relative_fpath), cloud_files.get(relative_fpath)
+            entry = self.manifest.get(relative_fpath) if self.manifest is not None else None
+            if local is None:
+                if direction == 'push' or (direction == 'both' and entry is not None):
+                    plan['delete_remote' if delete else 'skip'].append(relative_fpath)
+                else:
+                    plan['pull'].append(relative_fpath)
+                continue
+            if cloud is None:
+                if direction == 'pull' or (direction == 'both' and entry is not None):
+                    plan['delete_local' if delete else 'skip'].append(relative_fpath)
+                else:
+                    plan['push'].append(relative_fpath)
+                continue
+            if entry is None:
+                # Same rule as `sync`: the newer side wins
+                local_changed, cloud_changed = local[0] != cloud[0] or local[1] > cloud[1], local[0] != cloud[0] or cloud[1] > local[1]
+            else:
+                local_changed = (entry['size'], entry['mtime']) != local
+                cloud_changed = cloud[0] != entry['size'] or cloud[1] > entry['synced_at']
+            if direction == 'both' and local_changed and cloud_changed:
+                plan['push' if local[1] >= cloud[1] else 'pull'].append(relative_fpath)
+            elif cloud_changed and direction in ('pull', 'both') and (entry is not None or cloud[1] > local[1]):
+                plan['pull'].append(relative_fpath)
+            elif local_changed and direction in ('push', 'both') and (entry is not None or local[1] > cloud[1]):
+                plan['push'].append(relative_fpath)
+            else:
+                plan['skip'].append(relative_fpath)
+        return plan
+
+    def sync_tree(self, rel_dir='', direction='pull', include=None, exclude=None, delete=False, dry_run=False, workers=None, callback=None):
+        # Mirror a folder by diffing one scan of each tree. With `delete`, files removed on the source side are removed on the other; in `both` directions a file is considered removed if the manifest knows it.
+        if direction not in ('pull', 'push', 'both'):
+            warn('Unsupported sync direction [%s]!' % direction)
+            return [], None
+        start_time = time.time()
+        local_files = scan_tree(self.local_path_root, rel_dir, include=include, exclude=exclude)
+        cloud_files = scan_tree(self.cloud_path_root, rel_dir, include=include, exclude=exclude, scandir=self._cloud_scandir)
+        plan = self._plan_tree(local_files, cloud_files, direction, delete)
+        results = [dict(fpath=os.path.join(self.local_path_root, relative_fpath), relpath=relative_fpath, action=action, bytes=(cloud_files if action == 'pull' else local_files)[relative_fpath][0] if action in ('push', 'pull') else 0, seconds=0.0, ok=True) for action in ['pull', 'push', 'delete_local', 'delete_remote'] for relative_fpath in plan[action]]
+        if not dry_run: self._execute(results, workers=workers, callback=callback)
+        summary = CloudShell._summarize(results, time.time() - start_time)
+        summary.update(skip=len(plan['skip']), dry_run=dry_run)
+        return results, summary
+
+    def _summarize(results, seconds):
+        summary = dict(files=len(results), bytes=sum(r['bytes'] for r in results), seconds=seconds, failed=sum(not r['ok'] for r in results))
+        for action in ['push', 'pull', 'skip', 'delete_local', 'delete_remote']:
+            summary[action] = sum(r['action'] == action for r in results)
+        summary['throughput'] = summary['bytes'] / seconds if seconds > 0 else 0.0
+        return summary
+
+    def _read_range(self, relative_fpath):
+        # (read(offset, length), close) over the remote file: through `rclone cat` if available, with the mounted path as
+        # the fallback when it is not or a `cat` fails
+        cloud_fpath = os.path.join(self.cloud_path_root, relative_fpath)
+        state, lock = dict(fd=None, fallback=False), threading.Lock()
+        def pread(offset, length):
+            with lock:
+                if state['fd'] is None: state['fd'] = os.open(cloud_fpath, os.O_RDONLY)
+                fd = state['fd']
+            return os.pread(fd, length, offset)
+        def read_range(offset, length):
+            if self.transfer is not None and not state['fallback'] and self.transfer.available():
+                data = self.transfer.cat(relative_fpath, offset, length)
+                if data is not None: return data
+                warn('rclone cat failed on [%s], reading from the mounted path' % relative_fpath)
+                state['fallback'] = True
+            return pread(offset, length)
+        def close():
+            with lock:
+                if state['fd'] is not None: os.close(state['fd'])
+                state['fd'] = None
+        return read_range, close
+
+    def open(self, fpath, mode='r', *args, lazy=False, block_size=BLOCK_SIZE, readahead=READAHEAD, **kwargs):
+        # With `lazy`, a file that is not synced yet is read block by block from the cloud instead of being copied first
+        if not lazy or 'w' in mode or 'a' in mode or '+' in mode or 'x' in mode:
+            if not self.sync(fpath): return None
+            return open(fpath, mode, *args, **kwargs)
+        mapped = self._map(fpath)
+        if mapped is None: return None
+        local_fpath, relative_fpath, cloud_fpath = mapped
+        self._wait_inflight(relative_fpath)
+        if os.path.exists(local_fpath): return open(local_fpath, mode, *args, **kwargs)
+        stat = self._cloud_stat(cloud_fpath)
+        if stat is None:
+            warn('Cannot find file [%s] on the cloud!' % cloud_fpath)
+            return None
+        self._count('misses')
+        cache_dir = self._block_cache_dir(relative_fpath, stat)
+        read_range, on_close = self._read_range(relative_fpath)
+        if self._readahead_pool is None and readahead:
+            with self._stats_lock:
+                if self._readahead_pool is None: self._readahead_pool = ThreadPoolExecutor(max_workers=max(1, self.workers))
+        # The block directory counts against `cache_size` and is kept from eviction while open
+        with self._stats_lock:
+            self._open_blocks[cache_dir] = self._open_blocks.get(cache_dir, 0) + 1
+        def close_reader():
+            on_close()
+            with self._stats_lock:
+                self._open_blocks[cache_dir] -= 1
+                if not self._open_blocks[cache_dir]: del self._open_blocks[cache_dir]
+            self.evict()
+        raw = BlockReader(read_range, stat.st_size, cache_dir, block_size=block_size, readahead=readahead, executor=self._readahead_pool, on_close=close_reader, cache_limit=self.cache_size)
+        fd = io.BufferedReader(raw, buffer_size=block_size)
+        return fd if 'b' in mode else io.TextIOWrapper(fd, encoding=kwargs.get('encoding'), errors=kwargs.get('errors'), newline=kwargs.get('newline'))
+
+    def _block_cache_dir(self, relative_fpath, stat=None):
+        # Blocks are keyed by the remote size and mtime, blocks of older versions are dropped
+        prefix = os.path.join(self.local_path_root, MANIFEST_DIRNAME, 'blocks', hashlib.md5(relative_fpath.encode('utf-8')).hexdigest())
+        if stat is None: return prefix
+        cache_dir = '%s-%i-%i' % (prefix, stat.st_size, int(stat.st_mtime))
+        for stale_dir in glob.glob(prefix + '-*'):
+            if stale_dir != cache_dir: shutil.rmtree(stale_dir, ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        # The directory mtime marks the last use for eviction
+        os.utime(cache_dir)
+        return cache_dir
+
+    def clear_block_cache(self, fpath=None):
+        if fpath is None:
+            shutil.rmtree(os.path.join(self.local_path_root, MANIFEST_DIRNAME, 'blocks'), ignore_errors=True)
+            return
+        mapped = self._map(fpath)
+        if mapped is None: return
+        for cache_dir in glob.glob(self._block_cache_dir(mapped[1]) + '-*'): shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def _frame_cache_fpath(self, relative_fpath, local_fpath, reader, args, kwargs):
+        # Named <file>-<source version>-<read key>: the version covers the source, the key the parser and read arguments
+        stat = os.stat(local_fpath)
+        entry = self.manifest.get(relative_fpath) if self.manifest is not None else None
+        version = hashlib.md5(repr((stat.st_size, stat.st_mtime, entry['hash'] if entry else None)).encode('utf-8')).hexdigest()
+        key = hashlib.md5(repr((reader, args, sorted(kwargs.items()))).encode('utf-8')).hexdigest()
+        prefix = os.path.join(self.local_path_root, MANIFEST_DIRNAME, 'frames', hashlib.md5(relative_fpath.encode('utf-8')).hexdigest())
+        return prefix, version, '%s-%s-%s.feather' % (prefix, version, key)
+
+    def _read_frame(self, reader, fpath, args, kwargs, cache=False):
+        if not self.sync(fpath): return None
+        import pandas
+        if not cache or kwargs.get('chunksize') or kwargs.get('iterator'): return getattr(pandas, reader)(fpath, *args, **kwargs)
+        try:
+            import pyarrow, pyarrow.feather
+        except ImportError:
+            warn('The columnar cache requires pyarrow, reading [%s] without it.' % fpath)
+            return getattr(pandas, reader)(fpath, *args, **kwargs)
+        local_fpath, relative_fpath, _ = self._map(fpath)
+        prefix, version, cache_fpath = self._frame_cache_fpath(relative_fpath, local_fpath, reader, args, kwargs)
+        if os.path.exists(cache_fpath):
+            try:
+                os.utime(cache_fpath)
+                return pyarrow.feather.read_table(cache_fpath, memory_map=True).to_pandas()
+            except Exception as e:
+                warn('Failed to load the cached frame of [%s]: %s' % (fpath, e))
+        dataframe = getattr(pandas, reader)(fpath, *args, **kwargs)
+        if not isinstance(dataframe, pandas.DataFrame): return dataframe
+        try:
+            table = pyarrow.Table.from_pandas(dataframe, preserve_index=True)
+            mkdir(os.path.dirname(cache_fpath))
+            tmp_fpath = '%s.%i.tmp' % (cache_fpath, threading.get_ident())
+            pyarrow.feather.write_feather(table, tmp_fpath, compression='uncompressed')
+            os.replace(tmp_fpath, cache_fpath)
+            # Frames of older versions of the source are stale, those of other read arguments stay valid
+            for stale_fpath in glob.glob(prefix + '-*.feather'):
+                if not stale_fpath.startswith('%s-%s-' % (prefix, version)): os.remove(stale_fpath)
+        except Exception as e:
+            warn('Cannot cache the frame of [%s]: %s' % (fpath, e))
+        self.evict()
+        return dataframe
+
+    def read_csv(self, fpath, *args, cache=False, **kwargs):
+        # With `cache`, the parsed frame is kept as uncompressed Feather and memory-mapped by later calls
+        return self._read_frame('read_csv', fpath, args, kwargs, cache=cache)
+
+    def read_excel(self, fpath, *args, cache=False, **kwargs):
+        return self._read_frame('read_excel', fpath, args, kwargs, cache=cache)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+###########################################################################
+# Copyright (C) 2013-2022 by Caspar. All rights reserved.
+# File Name: supervisor.py
+# Author: Shankai Yan
+# E-mail: dr.skyan@gmail.com
+# Created Time: 2022-02-25 11:06:19
+###########################################################################
+#
+
+import os, time, socket, threading, subprocess
+
+from .metrics import log, warn
+
+
+READY_TIMEOUT = 60
+PROBE_INTERVAL = 0.2
+WATCH_INTERVAL = 5
+MAX_RESTARTS = 5
+
+
+def port_probe(port, host='127.0.0.1', timeout=1):
+    # Ready once something accepts connections on the port
+    def probe():
+        try:
+            with socket.create_connection((host, int(port)), timeout=timeout):
+                return True
+        except OSError:
+            return False
+    return probe
+
+
+def mount_probe(path):
+    # Ready once the path is a mountpoint that can be listed
+    def probe():
+        try:
+            return os.path.ismount(path) and os.listdir(path) is not None
+        except OSError:
+            return False
+    return probe
+
+
+def unmount(path):
+    # Lazily detach a mountpoint left behind by a dead FUSE process, ignoring any error
+    for exe in ['fusermount', 'fusermount3']:
+        try:
+            if subprocess.run([exe, '-uz', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0: return True
+        except OSError:
+            pass
+    return False
+
+
+class Daemon(object):
+    # A background process with a readiness probe. Its output goes to `log_fpath`, `before_start` runs before every (re)start.
+    def __init__(self, name, cmd, probe, log_fpath=os.devnull, before_start=None, ready_timeout=READY_TIMEOUT, cwd=None, env=None):
+        self.name = name
+        self.cmd = cmd
+        self.probe = probe
+        self.log_fpath = log_fpath
+        self.before_start = before_start
+        self.ready_timeout = ready_timeout
+        self.cwd = cwd
+        self.env = env
+        self.p = None
+        self.adopted = False
+        self.started_at = None
+        self.restarts = 0
+
+    @property
+    def pid(self):
+        return None if self.p is None else self.p.pid
+
+    def alive(self):
+        # An adopted daemon was started elsewhere, it is alive as long as its probe passes
+        if self.adopted: return self.probe()
+        return self.p is not None and self.p.poll() is None
+
+    def healthy(self):
+        return self.alive() and self.probe()
+
+    def uptime(self):
+        return 0.0 if self.started_at is None or not self.alive() else time.time() - self.started_at
+
+    def start(self):
+        if self.before_start is not None: self.before_start()
+        with open(self.log_fpath, 'ab') as log_fd:
+            self.p = subprocess.Popen(self.cmd, stdin=subprocess.DEVNULL, stdout=log_fd, stderr=subprocess.STDOUT, cwd=self.cwd, env=self.env, start_new_session=True)
+        self.adopted = False
+        self.started_at = time.time()
+        return self
+
+    def adopt(self):
+        # Take over a server that is already serving, e.g. one started by an earlier session
+        self.p, self.adopted, self.started_at = None, True, time.time()
+        return self
+
+    def _log_tail(self, nbytes=1000):
+        try:
+            with open(self.log_fpath, 'rb') as fd:
+                fd.seek(max(0, os.path.getsize(self.log_fpath) - nbytes))
+                return fd.read().decode('utf-8', 'replace').strip()
+        except OSError:
+            return ''
+
+    def wait_ready(self, timeout=None):
+        # Block until the probe passes. Raise RuntimeError if the process exits first and TimeoutError after `timeout` seconds.
+        timeout = self.ready_timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        while not self.probe():
+            if not self.adopted and self.p is not None and self.p.poll() is not None:
+                raise RuntimeError('%s exited with code %i before it was ready: %s' % (self.name, self.p.returncode, self._log_tail()))
+            if time.time() >= deadline:
+                raise TimeoutError('%s was not ready within %ss: %s' % (self.name, timeout, self._log_tail()))
+            time.sleep(PROBE_INTERVAL)
+        return True
+
+    def stop(self, timeout=10):
+        if self.p is None or self.p.poll() is not None: return True
+        self.p.terminate()
+        try:
+            self.p.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.p.kill()
+            self.p.wait()
+        return True
+
+    def health(self):
+        alive = self.alive()
+        return dict(name=self.name, pid=self.pid, adopted=self.adopted, alive=alive, ready=alive and self.probe(), uptime=self.uptime(), restarts=self.restarts,
+            returncode=None if self.p is None else self.p.poll())
+
+
+class Supervisor(object):
+    # Keeps named daemons running: a healthy daemon is reused, a dead one is restarted by a watcher thread every `interval`
+    # seconds with exponential backoff, up to `max_restarts` times.
+    def __init__(self, interval=WATCH_INTERVAL, max_restarts=MAX_RESTARTS, verbose=False):
+        self.interval = interval
+        self.max_restarts = max_restarts
+        self.verbose = verbose
+        self.daemons = {}
+        self._next_restart = {}
+        self._starting = set()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._watcher = None
+
+    def ensure(self, daemon, restart=False, timeout=None):
+        # Start the daemon unless the same name is already healthy (or its probe passes, in which case the running server
+        # is adopted), then block until it is ready. A daemon running another command (e.g. a mount with other flags) is
+        # restarted. Return the supervised daemon.
+        with self._lock:
+            current = self.daemons.get(daemon.name)
+            if current is not None and not restart and current.cmd != daemon.cmd:
+                warn('%s is running with other arguments, restarting it' % daemon.name)
+                restart = True
+            if current is not None and restart:
+                current.stop()
+                current = None
+            if current is not None and current.healthy():
+                if self.verbose: log('Reusing %s (pid %s, up %.0fs)' % (current.name, current.pid, current.uptime()))
+                return current
+            if current is not None: current.stop()
+            if not restart and daemon.probe():
+                if self.verbose: log('Adopting the running %s' % daemon.name)
+                self.daemons[daemon.name] = daemon.adopt()
+                # An adopted server is restarted by the watcher as well once it stops serving
+                self._start_watcher()
+                return daemon
+            self._starting.add(daemon.name)
+            daemon.start()
+            self.daemons[daemon.name] = daemon
+            self._start_watcher()
+        try:
+            daemon.wait_ready(timeout)
+        except Exception:
+            with self._lock:
+                if self.daemons.get(daemon.name) is daemon: del self.daemons[daemon.name]
+            daemon.stop()
+            raise
+        finally:
+            with self._lock:
+                self._starting.discard(daemon.name)
+        if self.verbose: log('%s is ready (pid %s)' % (daemon.name, daemon.pid))
+        return daemon
+
+    def _start_watcher(self):
+        if self._watcher is not None and self._watcher.is_alive(): return
+        self._stop.clear()
+        self._watcher = threading.Thread(target=self._watch, name='supervisor', daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                daemons = list(self.daemons.values())
+            for daemon in daemons:
+                if daemon.alive() or daemon.restarts >= self.max_restarts or time.time() < self._next_restart.get(daemon.name, 0): continue
+                with self._lock:
+                    if self.daemons.get(daemon.name) is not daemon or daemon.name in self._starting: continue
+                    daemon.restarts += 1
+                    self._next_restart[daemon.name] = time.time() + min(60, 2 ** daemon.restarts)
+                    warn('%s died (code %s), restarting (%i/%i)' % (daemon.name, None if daemon.p is None else daemon.p.poll(), daemon.restarts, self.max_restarts))
+                    try:
+                        daemon.start()
+                    except OSError as e:
+                        warn('Failed to restart %s: %s' % (daemon.name, e))
+                        continue
+                try:
+                    daemon.wait_ready()
+                except Exception as e:
+                    warn('Failed to restart %s: %s' % (daemon.name, e))
+
+    def get(self, name):
+        return self.daemons.get(name)
+
+    def health(self, name=None):
+        with self._lock:
+            if name is not None: return self.daemons[name].health() if name in self.daemons else None
+            return dict((k, d.health()) for k, d in self.daemons.items())
+
+    def stop(self, name=None):
+        with self._lock:
+            names = list(self.daemons) if name is None else [name]
+            for n in names:
+                daemon = self.daemons.pop(n, None)
+                if daemon is not None: daemon.stop()
+            if not self.daemons: self._stop.set()
+
+
+SUPERVISOR = Supervisor()
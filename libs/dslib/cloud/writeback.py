@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+###########################################################################
+# Copyright (C) 2013-2022 by Caspar. All rights reserved.
+# File Name: writeback.py
+# Author: Shankai Yan
+# E-mail: dr.skyan@gmail.com
+# Created Time: 2022-02-18 10:37:52
+###########################################################################
+#
+
+import time, atexit, threading, collections
+
+from .metrics import log, warn
+
+
+class WriteBackQueue(object):
+    # Uploads keys in background threads. A key queued again before its upload starts is merged into the pending one,
+    # a key queued while it is uploading is uploaded once more afterwards.
+    def __init__(self, upload, workers=1, verbose=False):
+        self.upload = upload
+        self.verbose = verbose
+        self.stats = dict(queued=0, merged=0, uploaded=0, failed=0)
+        self._pending = collections.OrderedDict()
+        self._running = set()
+        self._redo = set()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._work, name='writeback-%i' % i, daemon=True) for i in range(max(1, workers))]
+        for thread in self._threads: thread.start()
+        atexit.register(self.close)
+
+    def put(self, key):
+        with self._cond:
+            if self._closed: raise RuntimeError('The write-back queue is closed!')
+            if key in self._pending:
+                self.stats['merged'] += 1
+            elif key in self._running:
+                self.stats['merged'] += 1
+                self._redo.add(key)
+            else:
+                self.stats['queued'] += 1
+                self._pending[key] = time.time()
+                self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed: self._cond.wait()
+                if not self._pending: return
+                key, _ = self._pending.popitem(last=False)
+                self._running.add(key)
+            try:
+                ok = self.upload(key)
+            except Exception as e:
+                warn('Failed to upload [%s]: %s' % (key, e))
+                ok = False
+            with self._cond:
+                self._running.discard(key)
+                self.stats['uploaded' if ok else 'failed'] += 1
+                if key in self._redo:
+                    self._redo.discard(key)
+                    self._pending[key] = time.time()
+                if self.verbose: log('Uploaded %s (%i in queue)' % (key, len(self._pending) + len(self._running)))
+                self._cond.notify_all()
+
+    def depth(self):
+        with self._cond:
+            return len(self._pending) + len(self._running)
+
+    def flush(self, timeout=None):
+        # Block until every queued upload has finished, return False on timeout
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._running, timeout=timeout)
+
+    wait = flush
+
+    def close(self, timeout=None):
+        # Drain the queue and stop the uploaders
+        with self._cond:
+            if self._closed: return True
+            self._closed = True
+            self._cond.notify_all()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
+        atexit.unregister(self.close)
+        return not any(thread.is_alive() for thread in self._threads)